@@ -113,6 +113,8 @@ display(rankedDF)
 # MAGIC %md
 # MAGIC As desired, we get only the newest (**`rank == 1`**) entry for each unique **`user_id`**.
 # MAGIC 
+# MAGIC Note that ranking sorts every partition of the window, and that two records sharing the newest **`timestamp`** would both be ranked 1 and kept.
+# MAGIC 
 # MAGIC Unfortunately, if we try to apply this to a streaming read of our data, we'll learn that
 # MAGIC > Non-time-based windows are not supported on streaming DataFrames
 
@@ -175,7 +177,9 @@ unpackedDF = (spark.readStream
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC The updated Window logic is provided below. Note that this is being applied to each **`microBatchDF`** to result in a local **`rankedDF`** that will be used for merging.
+# MAGIC The ranking logic is applied below to each **`microBatchDF`** to result in a local set of ranked updates that will be used for merging.
+# MAGIC 
+# MAGIC Rather than a **`Window`**, it uses the **`latest_per_key`** function defined in the included utility functions. This keeps the newest record per key with a single aggregation over a struct of the columns, led by **`updated`**. This avoids sorting each partition, and the remaining columns break any ties so that exactly one record per **`alt_id`** reaches the **`MERGE`**, which would otherwise fail on duplicate keys.
 # MAGIC  
 # MAGIC For our **`MERGE`** statement, we need to:
 # MAGIC - Match entries on our **`alt_id`**
@@ -186,16 +190,10 @@ unpackedDF = (spark.readStream
 
 # COMMAND ----------
 
-from pyspark.sql.window import Window
-
-window = Window.partitionBy("alt_id").orderBy(F.col("updated").desc())
-
 def batch_rank_upsert(microBatchDF, batchId):
     appId = "batch_rank_upsert"
     
-    (microBatchDF
-        .filter(F.col("update_type").isin(["new", "update"]))
-        .withColumn("rank", F.rank().over(window)).filter("rank == 1").drop("rank")
+    (latest_per_key(microBatchDF.filter(F.col("update_type").isin(["new", "update"])), ["alt_id"], "updated")
         .createOrReplaceTempView("ranked_updates"))
     
     microBatchDF._jdf.sparkSession().sql("""
@@ -240,12 +240,10 @@ except:
 # MAGIC If you try to execute this code right now, you'll raise an exception
 # MAGIC > Detected deleted data from streaming source
 # MAGIC 
-# MAGIC Line 22 of the cell below adds the **`.option("ignoreDeletes", True)`** to the DataStreamReader. This option is all that is necessary to enable streaming processing from Delta tables with partition deletes.
+# MAGIC Line 20 of the cell below adds the **`.option("ignoreDeletes", True)`** to the DataStreamReader. This option is all that is necessary to enable streaming processing from Delta tables with partition deletes.
 
 # COMMAND ----------
 
-from pyspark.sql.window import Window
-
 schema = """
     user_id LONG, 
     update_type STRING, 
@@ -276,15 +274,10 @@ unpackedDF = (spark.readStream
         'sex', 'gender','first_name','last_name',
         'address.*', "update_type"))
 
-
-window = Window.partitionBy("alt_id").orderBy(F.col("updated").desc())
-
 def batch_rank_upsert(microBatchDF, batchId):
     appId = "batch_rank_upsert"
     
-    (microBatchDF
-        .filter(F.col("update_type").isin(["new", "update"]))
-        .withColumn("rank", F.rank().over(window)).filter("rank == 1").drop("rank")
+    (latest_per_key(microBatchDF.filter(F.col("update_type").isin(["new", "update"])), ["alt_id"], "updated")
         .createOrReplaceTempView("ranked_updates"))
     
     microBatchDF._jdf.sparkSession().sql("""
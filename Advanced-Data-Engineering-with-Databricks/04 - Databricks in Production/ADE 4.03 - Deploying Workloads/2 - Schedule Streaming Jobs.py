@@ -128,26 +128,21 @@ spark.conf.set("spark.databricks.delta.autoCompact.enabled", True)
 
 # MAGIC %md
 # MAGIC # Bronze
+# MAGIC 
+# MAGIC Rather than joining every record to a cached, broadcast **`date_lookup`**, the **`week_part`** is derived with an expression that is first verified against every date in **`date_lookup`** (see **`resolve_week_part`** in the included utility functions). Should no expression reproduce the lookup, the broadcast join is used instead.
 
 # COMMAND ----------
 
-dateLookup = spark.table("date_lookup").select("date", "week_part")
-dateLookup.cache().count()
+add_week_part = resolve_week_part("date_lookup")
 
 # COMMAND ----------
 
-def process_bronze(source, table_name, checkpoint, once=False, processing_time="5 seconds"):
+def process_bronze(source, table_name, checkpoint, once=False, processing_time="5 seconds", landing_format="json", max_files_per_trigger=2):
     from pyspark.sql import functions as F
     
     schema = "key BINARY, value BINARY, topic STRING, partition LONG, offset LONG, timestamp LONG"
     
-    data_stream_writer = (spark.readStream
-            .format("cloudFiles")
-            .schema(schema)
-            .option("maxFilesPerTrigger", 2)
-            .option("cloudFiles.format", "json")
-            .load(source)
-            .join(F.broadcast(dateLookup), [F.to_date((F.col("timestamp")/1000).cast("timestamp")) == F.col("date")], "left")
+    data_stream_writer = (add_week_part(read_landing_stream(source, schema, landing_format, maxFilesPerTrigger=max_files_per_trigger))
             .writeStream
             .option("checkpointLocation", checkpoint)
             .partitionBy("topic", "week_part")
@@ -160,12 +155,23 @@ def process_bronze(source, table_name, checkpoint, once=False, processing_time="
             .table(table_name)
             .awaitTermination(60))
     else:
-        (data_stream_writer
+        return (data_stream_writer
             .trigger(processingTime=processing_time)
             .table(table_name))
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Adaptive Admission Control
+# MAGIC 
+# MAGIC A fixed **`maxFilesPerTrigger`** either lags behind when data lands faster than expected or leaves the cluster idle when it lands slower.
+# MAGIC 
+# MAGIC When run continuously, the bronze stream is instead started through an **`AdmissionController`** (defined in the included utility functions). Between triggers, it reads the batch duration and the source backlog from the query progress. It then resizes **`maxFilesPerTrigger`** so that each batch completes within the 5 second trigger interval while processing as many files as that allows.
+# MAGIC 
+# MAGIC Call **`bronze_controller.report()`** to review how the limit was adjusted.
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Configure Apache Spark Scheduler Pools for Efficiency
 # MAGIC 
@@ -190,25 +196,40 @@ def process_bronze(source, table_name, checkpoint, once=False, processing_time="
 # COMMAND ----------
 
 spark.sparkContext.setLocalProperty("spark.scheduler.pool", "bronze")
-process_bronze(DA.paths.producer_30m, "bronze_dev", f"{DA.paths.checkpoints}/bronze", once=once)
+
+if once == True:
+    process_bronze(DA.paths.producer_30m, "bronze_dev", f"{DA.paths.checkpoints}/bronze", once=True)
+else:
+    bronze_controller = AdmissionController(
+        lambda max_files: process_bronze(DA.paths.producer_30m, "bronze_dev", f"{DA.paths.checkpoints}/bronze", processing_time="5 seconds", max_files_per_trigger=max_files), 
+        trigger_seconds=5)
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC # Parse Silver Tables
+# MAGIC ## Compacting Closed Partitions
+# MAGIC 
+# MAGIC Auto Optimize and Auto Compaction work within each write, but a stream triggering every 5 seconds still leaves many small files in each **`topic`**/**`week_part`** partition.
 # MAGIC 
-# MAGIC In the next cell, we define a Python class to handle the queries that result in our **`heart_rate_silver`** and **`workouts_silver`**.
+# MAGIC The **`CompactionScheduler`** class (defined in the included utility functions) reads the file count and size of each partition from the add and remove actions of the Delta log. Every minute, it runs **`OPTIMIZE`** on the partitions of closed weeks that hold many small files. Closed weeks are all but the **`week_part`** holding the newest **`date`** (going by the statistics Delta keeps per file), so the compaction never touches a partition the stream is still writing to.
 
 # COMMAND ----------
 
-class Upsert:
-    def __init__(self, query, update_temp="stream_updates"):
-        self.query = query
-        self.update_temp = update_temp 
-        
-    def upsertToDelta(self, microBatchDF, batch):
-        microBatchDF.createOrReplaceTempView(self.update_temp)
-        microBatchDF._jdf.sparkSession().sql(self.query)
+if once == True:
+    CompactionScheduler("bronze_dev").compact()
+else:
+    bronze_compactor = CompactionScheduler("bronze_dev", interval=60)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Parse Silver Tables
+# MAGIC 
+# MAGIC The queries that result in our **`heart_rate_silver`** and **`workouts_silver`** are handled by the **`Upsert`** class defined in the included utility functions.
+# MAGIC 
+# MAGIC Given a **`time_col`**, it adds the micro-batch's range of that column to the **`ON`** clause of each **`MERGE`**, so that Delta can skip every file of the target that cannot match. Call **`report()`** on an instance to compare the files scanned with the files skipped for each batch.
+# MAGIC 
+# MAGIC These per-topic streams are not started by this notebook, which uses the demultiplexer defined further below. They remain available for scheduling a topic on its own.
 
 # COMMAND ----------
 
@@ -223,7 +244,7 @@ def heart_rate_silver(source_table="bronze", once=False, processing_time="10 sec
         WHEN NOT MATCHED THEN INSERT *
         """
 
-    streamingMerge=Upsert(query, "heart_rate_updates")
+    streamingMerge=Upsert(query, "heart_rate_updates", time_col="time")
     
     data_stream_writer = (spark.readStream
         .option("ignoreDeletes", True)
@@ -265,7 +286,7 @@ def workouts_silver(source_table="bronze", once=False, processing_time="15 secon
         WHEN NOT MATCHED THEN INSERT *
         """
 
-    streamingMerge=Upsert(query, "workout_updates")
+    streamingMerge=Upsert(query, "workout_updates", time_col="time")
     
     data_stream_writer = (spark.readStream
         .option("ignoreDeletes", True)
@@ -301,14 +322,10 @@ def workouts_silver(source_table="bronze", once=False, processing_time="15 secon
 # users
 
 def batch_rank_upsert(microBatchDF, batchId):
-    from pyspark.sql.window import Window
     from pyspark.sql import functions as F
 
-    window = Window.partitionBy("alt_id").orderBy(F.col("updated").desc())
-    
-    (microBatchDF
-        .filter(F.col("update_type").isin(["new", "update"]))
-        .withColumn("rank", F.rank().over(window)).filter("rank == 1").drop("rank")
+    # One row per alt_id, the latest by updated (see latest_per_key in the utility functions)
+    (latest_per_key(microBatchDF.filter(F.col("update_type").isin(["new", "update"])), ["alt_id"], "updated")
         .createOrReplaceTempView("ranked_updates"))
     
     microBatchDF._jdf.sparkSession().sql("""
@@ -342,11 +359,13 @@ def users_silver(source_table="bronze", once=False, processing_time="30 seconds"
 
     salt = "BEANS"
 
-    data_stream_writer = (spark.readStream
+    bronzeDF = (spark.readStream
         .option("ignoreDeletes", True)
         .table(source_table)
-        .filter("topic = 'user_info'")
-        .dropDuplicates()
+        .filter("topic = 'user_info'"))
+
+    # A watermark on the record's (Kafka) timestamp bounds the dedup state (see dedup_by_hash)
+    data_stream_writer = (dedup_by_hash(bronzeDF, "30 seconds")
         .select(F.from_json(F.col("value").cast("string"), schema).alias("v")).select("v.*")
         .select(F.sha2(F.concat(F.col("user_id"), F.lit(salt)), 256).alias("alt_id"),
             F.col('timestamp').cast("timestamp").alias("updated"),
@@ -374,13 +393,72 @@ def users_silver(source_table="bronze", once=False, processing_time="30 seconds"
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Demultiplexing the Bronze Table
+# MAGIC 
+# MAGIC Each of the three functions above opens its own stream against the same multiplex table, so every file in bronze is scanned once per topic.
+# MAGIC 
+# MAGIC The **`SilverDemux`** class (defined in the included utility functions) instead reads bronze once and, in a single **`foreachBatch`**, routes the rows of each topic through the parser registered for that topic (**`silver_parsers`**) and on to its silver writer.
+# MAGIC 
+# MAGIC Here the demultiplexer serves **`heart_rate_silver`** and **`workouts_silver`**, whose writers are idempotent and need no state. The **`users`** stream keeps its own watermarked deduplication and is scheduled on its own.
+# MAGIC 
+# MAGIC The other two functions above remain available should you want to schedule those topics on their own.
+
+# COMMAND ----------
+
+# silver demultiplexer
+def silver_demux(source_table="bronze", once=False, processing_time="10 seconds"):
+    checkpoint = f"{DA.paths.checkpoints}/silver_demux"
+
+    # Insert-only merges are replaced with an anti-join and idempotent append (see InsertOnlyUpsert)
+    heart_rate_merge = InsertOnlyUpsert("heart_rate_silver", ["device_id", "time"], checkpoint)
+    workouts_merge = InsertOnlyUpsert("workouts_silver", ["user_id", "time"], checkpoint)
+
+    demux = (SilverDemux()
+        .route("bpm", heart_rate_merge.upsertToDelta)
+        .route("workout", workouts_merge.upsertToDelta))
+
+    data_stream_writer = (demux.stream_writer(source_table)
+        .option("checkpointLocation", checkpoint)
+        .queryName("silver_demux")
+    )
+
+    if once == True:
+        (data_stream_writer
+            .trigger(once=True)
+            .start()
+            .awaitTermination(60)
+        )
+    else:
+        (data_stream_writer
+            .trigger(processingTime=processing_time)
+            .start()
+        )
+
+# COMMAND ----------
+
 spark.sparkContext.setLocalProperty("spark.scheduler.pool", "silver_parsed")
-heart_rate_silver(source_table="bronze_dev", once=once)
-workouts_silver(source_table="bronze_dev", once=once)
+silver_demux(source_table="bronze_dev", once=once)
 users_silver(source_table="bronze_dev", once=once)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Monitoring State
+# MAGIC 
+# MAGIC The watermarked **`dropDuplicates`** of the **`users`** stream, and its RocksDB state store, only stay small if the watermark actually evicts state.
+# MAGIC 
+# MAGIC The **`StateMonitor`** class (defined in the included utility functions) records the **`stateOperators`** metrics of the **`users`** stream into the **`state_metrics`** table every 30 seconds. These include state rows, memory used, and rows dropped by the watermark, along with how late each batch's oldest event arrived.
+# MAGIC 
+# MAGIC Before the streams are stopped below, **`state_monitor.analyze()`** flags any state that only ever grew and suggests a watermark from the lateness observed.
+
+# COMMAND ----------
+
+if once == False:
+    state_monitor = StateMonitor(query_names=["users"])
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC # Loading Data
 # MAGIC A close observation will reveal that no data is actually being processed.
@@ -405,7 +483,18 @@ time.sleep(5*60)
 
 # COMMAND ----------
 
-# MAGIC %md And now that the five minutes have passed, we will stop all streams.
+# MAGIC %md And now that the five minutes have passed, we will review the state of our streams and stop them all.
+
+# COMMAND ----------
+
+if once == False:
+    bronze_controller.stop()
+    
+    bronze_compactor.stop()
+    bronze_compactor.report()
+    
+    state_monitor.stop()
+    state_monitor.analyze()
 
 # COMMAND ----------
 
@@ -414,6 +503,10 @@ for stream in spark.streams.active:
     stream.stop()
     stream.awaitTermination()
 
+# Reported once everything has stopped, as it raises should the bronze stream have failed
+if once == False:
+    bronze_controller.report()
+
 # COMMAND ----------
 
 # MAGIC %md-sandbox
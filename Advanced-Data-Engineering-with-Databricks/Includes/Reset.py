@@ -27,8 +27,11 @@ if DA.paths.exists(DA.working_dir_prefix):
 # COMMAND ----------
 
 # Recreate the "source" database to facilitate faster test execution and prevent multiple lessons from creating.
-create_source_database()          # Create the source database
-create_producer_table_source()    # Clone the producer table
-create_date_lookup_source()
-create_user_lookup_source()
+(SetupGraph()
+    .step("source_database", create_source_database)                                # Create the source database
+    .step("producer_source", create_producer_table_source, ["source_database"])     # Clone the producer table
+    .step("date_lookup_source", create_date_lookup_source, ["source_database"])     # Clone the date_lookup table
+    .step("user_lookup_source", create_user_lookup_source, ["source_database"])     # Clone the user_lookup table
+    .step("producer_daily", create_producer_daily_source, ["producer_source"])      # Stage the producer table by day for the data factory
+    .run())
 
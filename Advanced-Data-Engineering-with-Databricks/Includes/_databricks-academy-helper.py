@@ -38,6 +38,10 @@ class DBAcademyHelper():
 
         self.db_name_prefix = f"dbacademy_{clean_username}_{self.course_name}"
         self.source_db_name = None
+        self.stage_cache = None
+        self.stream_retries = []
+        self.progress_listener = None
+        self._progress_condition = None
 
         self.working_dir_prefix = f"dbfs:/user/{self.username}/dbacademy/{self.course_name}"
         
@@ -62,19 +66,48 @@ class DBAcademyHelper():
             spark.sql(f"CREATE DATABASE IF NOT EXISTS {self.db_name} LOCATION '{self.paths.user_db}'")
             spark.sql(f"USE {self.db_name}")
 
-    def cleanup(self):
-        for stream in spark.streams.active:
+    def cleanup(self, stream_timeout=60, max_workers=8):
+        from concurrent.futures import ThreadPoolExecutor
+        
+        def stop_stream(stream):
             print(f"Stopping the stream \"{stream.name}\"")
-            stream.stop()
-            try: stream.awaitTermination()
+            try: 
+                stream.stop()
+                if stream.awaitTermination(stream_timeout) == False:
+                    print(f"The stream \"{stream.name}\" did not stop within {stream_timeout} seconds")
             except: pass # Bury any exceptions
-
-        if spark.sql(f"SHOW DATABASES").filter(f"databaseName == '{self.db_name}'").count() == 1:
+        
+        # Bound each stop() by the deadline as well, it otherwise waits on the stream indefinitely
+        stop_timeout = spark.conf.get("spark.sql.streaming.stopTimeout", "0")
+        spark.conf.set("spark.sql.streaming.stopTimeout", f"{stream_timeout}s")
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(stop_stream, spark.streams.active))
+        finally:
+            spark.conf.set("spark.sql.streaming.stopTimeout", stop_timeout)
+        
+        # The listener outlives the lesson otherwise, one more with every run on the cluster
+        if self.progress_listener is not None:
+            spark.streams.removeListener(self.progress_listener)
+            self.progress_listener = None
+            self._progress_condition = None
+
+        # Checked against the catalog directly, without running a Spark job
+        if spark.catalog._jcatalog.databaseExists(self.db_name):
             print(f"Dropping the database \"{self.db_name}\"")
             spark.sql(f"DROP DATABASE {self.db_name} CASCADE")
             
         if self.paths.exists(self.paths.working_dir):
             print(f"Removing the working directory \"{self.paths.working_dir}\"")
+            
+            # Fan out over the table and checkpoint directories two levels down
+            paths = []
+            for entry in dbutils.fs.ls(self.paths.working_dir):
+                if entry.isDir(): paths += [child.path for child in dbutils.fs.ls(entry.path)]
+                else: paths.append(entry.path)
+            
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(lambda path: dbutils.fs.rm(path, True), paths))
             dbutils.fs.rm(self.paths.working_dir, True)
 
     def conclude_setup(self):
@@ -101,10 +134,62 @@ class DBAcademyHelper():
                 
         print(f"\nSetup completed in {int(time.time())-self.start} seconds")
         
-    def block_until_stream_is_ready(self, query, min_batches=2):
+    def progress_condition(self):
+        import threading
+        
+        # Wakes any waiting block_until_stream_is_ready() as soon as a stream reports progress.
+        # Without a Python StreamingQueryListener (Spark < 3.4) the waits fall back to polling.
+        if self._progress_condition is None:
+            self._progress_condition = threading.Condition()
+            try:
+                from pyspark.sql.streaming import StreamingQueryListener
+                
+                condition = self._progress_condition
+                class ProgressListener(StreamingQueryListener):
+                    def notify(self):
+                        with condition: condition.notify_all()
+                    def onQueryStarted(self, event): pass
+                    def onQueryProgress(self, event): self.notify()
+                    def onQueryIdle(self, event): pass
+                    def onQueryTerminated(self, event): self.notify()
+                
+                self.progress_listener = ProgressListener()
+                spark.streams.addListener(self.progress_listener)
+            except ImportError: pass
+        
+        return self._progress_condition
+        
+    def block_until_stream_is_ready(self, query, min_batches=2, min_input_rows=None, watermark_after=None, timeout=None, poll_interval=5):
         import time
-        while len(query.recentProgress) < min_batches:
-            time.sleep(5) # Give it a couple of seconds
+        from datetime import datetime
+        
+        def parse_time(value):
+            return value if isinstance(value, datetime) else datetime.fromisoformat(str(value).replace("Z", ""))
+        
+        def is_ready():
+            progress = query.recentProgress
+            if len(progress) < min_batches: 
+                return False
+            if min_input_rows is not None and sum(p["numInputRows"] for p in progress) < min_input_rows: 
+                return False
+            if watermark_after is not None:
+                watermark = progress[-1].get("eventTime", {}).get("watermark") if progress else None
+                if watermark is None or parse_time(watermark) <= parse_time(watermark_after): return False
+            return True
+        
+        start = time.time()
+        condition = self.progress_condition()
+        with condition:
+            while not is_ready():
+                if not query.isActive:
+                    if query.exception(): raise query.exception()
+                    raise RuntimeError(f"The stream \"{query.name}\" terminated before it was ready")
+                
+                remaining = None if timeout is None else timeout - (time.time() - start)
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"The stream \"{query.name}\" was not ready after {timeout} seconds")
+                
+                condition.wait(poll_interval if remaining is None else min(remaining, poll_interval))
 
         print(f"The stream has processed {len(query.recentProgress)} batchs")
         
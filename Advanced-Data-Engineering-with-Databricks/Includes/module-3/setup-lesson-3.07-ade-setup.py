@@ -12,19 +12,18 @@ DA.init()
 
 # COMMAND ----------
 
-# Create the source datasets
-create_source_database()          # Create the source database
-create_producer_table_source()    # Clone the producer table
-create_date_lookup_source()
-create_user_lookup_source()
+# Create the source and user datasets, running independent steps concurrently
+(SetupGraph()
+    .step("source_database", create_source_database)                                # Create the source database
+    .step("producer_source", create_producer_table_source, ["source_database"])     # Clone the producer table
+    .step("date_lookup_source", create_date_lookup_source, ["source_database"])     # Clone the date_lookup table
+    .step("user_lookup_source", create_user_lookup_source, ["source_database"])     # Clone the user_lookup table
+    .step("date_lookup", create_date_lookup, ["date_lookup_source"])                # Create static copy of date_lookup
+    .step("user_lookup", create_user_lookup, ["user_lookup_source"])                # Create the user-lookup table
+    .step("source_daily", init_source_daily, ["producer_source"])                   # Create the data factory
+    .run())
 print()
 
-# Create the user datasets
-create_date_lookup()              # Create static copy of date_lookup
-create_user_lookup()              # Create the user-lookup table
-print()
-
-init_source_daily()               # Create the data factory
 DA.data_factory.load()            # Load one new day for DA.paths.source_daily
 
 DA.process_bronze()               # Process through the bronze table
@@ -58,21 +58,18 @@ None # Suppressing Output
 
 # COMMAND ----------
 
-# Create the source datasets
-create_source_database()          # Create the source database
-create_producer_table_source()    # Clone the producer table
-create_date_lookup_source()
-# create_user_lookup_source()
-create_producer_30m_table_source()
-print()
-
-# Create the user datasets
-create_date_lookup()              # Create static copy of date_lookup
-
-# TODO - Implication from main notebook is that this should not be called
-# create_user_lookup()              # Create the user-lookup table
-
-clone_bronze_dev_table()
+# Create the source and user datasets, running independent steps concurrently
+(SetupGraph()
+    .step("source_database", create_source_database)                                # Create the source database
+    .step("producer_source", create_producer_table_source, ["source_database"])     # Clone the producer table
+    .step("date_lookup_source", create_date_lookup_source, ["source_database"])     # Clone the date_lookup table
+    # .step("user_lookup_source", create_user_lookup_source, ["source_database"])
+    .step("producer_30m_source", create_producer_30m_table_source, ["source_database"])
+    .step("date_lookup", create_date_lookup, ["date_lookup_source"])                # Create static copy of date_lookup
+    # TODO - Implication from main notebook is that this should not be called
+    # .step("user_lookup", create_user_lookup, ["user_lookup_source"])              # Create the user-lookup table
+    .step("bronze_dev", clone_bronze_dev_table, ["producer_source"])
+    .run())
 #create_producer_30m_table()
 
 print()
@@ -124,8 +124,7 @@ process_workout_bpm()
 
 DA.data_factory.load()          # Load one new day for DA.paths.source_daily
 DA.process_bronze()             # Process through the bronze table
-DA.process_heart_rate_silver()  # Process the heart_rate_silver table
-DA.process_workouts_silver()    # Process the workouts_silver table
+DA.process_silver()             # Process the heart_rate_silver, workouts_silver and users tables
 DA.process_completed_workouts() # Process the completed_workouts table
 
 process_workout_bpm()
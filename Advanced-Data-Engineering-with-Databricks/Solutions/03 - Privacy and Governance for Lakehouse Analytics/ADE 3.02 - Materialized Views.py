@@ -48,11 +48,9 @@
 
 DA.data_factory.load()            # Load one new day for DA.paths.source_daily
 DA.process_bronze()               # Process through the bronze table
-DA.process_heart_rate_silver()    # Process the heart_rate_silver table
-DA.process_workouts_silver()      # Process the workouts_silver table
+DA.process_silver()               # Process the heart_rate_silver, workouts_silver and users tables
 DA.process_completed_workouts()   # Process the completed_workouts table
 DA.process_workout_bpm()          # Process the workout_bpm table
-DA.process_users()                # Process the users tables
 DA.process_user_bins()            # Create the user_bins table
 
 # COMMAND ----------
@@ -112,29 +110,30 @@ spark.readStream.table("workout_bpm").createOrReplaceTempView("TEMP_workout_bpm"
 
 # MAGIC %md
 # MAGIC Using trigger once logic with Delta Lake, we can ensure that we'll only calculate new results if records have changed in the upstream source tables.
+# MAGIC 
+# MAGIC Joined inside the stream, the static **`user_bins`** table would be read and joined again for every micro-batch. Instead, the aggregation is handed to a **`WorkoutBpmSummaryWriter`** (defined in the included utility functions) with **`foreachBatch`**. It caches and broadcasts **`user_bins`** once, rebuilds it only when the Delta version of **`user_bins`** changes, and reports how often it did so.
 
 # COMMAND ----------
 
-user_bins_df = spark.sql("""
-    SELECT workout_id, session_id, a.user_id, age, gender, city, state, min_bpm, avg_bpm, max_bpm, num_recordings
-    FROM user_bins a
-    INNER JOIN
-      (SELECT user_id, workout_id, session_id, MIN(heartrate) min_bpm, MEAN(heartrate) avg_bpm, MAX(heartrate) max_bpm, COUNT(heartrate) num_recordings
-      FROM TEMP_workout_bpm
-      GROUP BY user_id, workout_id, session_id) b
-    ON a.user_id = b.user_id
+workout_bpm_agg_df = spark.sql("""
+    SELECT user_id, workout_id, session_id, MIN(heartrate) min_bpm, MEAN(heartrate) avg_bpm, MAX(heartrate) max_bpm, COUNT(heartrate) num_recordings
+    FROM TEMP_workout_bpm
+    GROUP BY user_id, workout_id, session_id
     """)
 
-(user_bins_df
+summary_writer = WorkoutBpmSummaryWriter(f"{DA.paths.checkpoints}/workout_bpm_summary.chk", path=f"{DA.paths.user_db}/workout_bpm_summary.delta")
+
+(workout_bpm_agg_df
      .writeStream
-     .format("delta")
+     .foreachBatch(summary_writer)
      .option("checkpointLocation", f"{DA.paths.checkpoints}/workout_bpm_summary.chk")
-     .option("path", f"{DA.paths.user_db}/workout_bpm_summary.delta")
      .outputMode("complete")
      .trigger(once=True)
-     .table("workout_bpm_summary")
+     .start()
      .awaitTermination())
 
+summary_writer.report()
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -50,6 +50,7 @@
 # MAGIC (user_id INT, workout_id INT, time TIMESTAMP, action STRING, session_id INT)
 # MAGIC USING DELTA
 # MAGIC LOCATION '${da.paths.user_db}/workouts_silver'
+# MAGIC TBLPROPERTIES (delta.enableChangeDataFeed = true)
 
 # COMMAND ----------
 
@@ -22,7 +22,6 @@
 
 from pyspark.sql import functions as F
 
-batch = 0
 producer_df = spark.read.table(f"{DA.source_db_name}.producer_30m")
 arrival_max, arrival_min = producer_df.select(F.max("arrival"), F.min("arrival")).collect()[0]
 
@@ -32,19 +31,33 @@ print(f"Total Batchs: {arrival_max-arrival_min:,}")
 
 # COMMAND ----------
 
-import time
-
-while arrival_min+batch < arrival_max+1:
-    start = time.time()*1000
-    
-    (producer_df.filter(F.col("arrival") == arrival_min+batch).drop("arrival")
-                .write
-                .mode("append")
-                .format("json")
-                .save(DA.paths.producer_30m))
-    
-    print(f"Batch #{batch+1} duration: {int(time.time()*1000-start):,} ms")
-    batch += 1
+# MAGIC %md
+# MAGIC ## Replaying at a Controlled Rate
+# MAGIC 
+# MAGIC Rather than writing each **`arrival`** as fast as Spark allows, the **`ReplayDataFactory`** replays the data on a schedule from a background thread.
+# MAGIC 
+# MAGIC Pass either:
+# MAGIC * **`compression`** to replay the original 30 minutes faster by that factor (for example, **`10`** replays it in 3 minutes), or
+# MAGIC * **`events_per_second`** to hold a fixed target throughput.
+# MAGIC 
+# MAGIC Here the 30 minutes are compressed into the 5 minutes that our streaming job runs for.
+
+# COMMAND ----------
+
+replay = ReplayDataFactory(f"{DA.source_db_name}.producer_30m", DA.paths.producer_30m, compression=6)
+replay.start()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC Once the replay completes, compare the achieved rate against the target.
+# MAGIC 
+# MAGIC Call **`replay.stop()`** to end the replay early.
+
+# COMMAND ----------
+
+replay.await_termination()
+replay.report()
 
 # COMMAND ----------
 
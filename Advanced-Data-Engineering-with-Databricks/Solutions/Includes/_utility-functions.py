@@ -12,6 +12,212 @@ None # Suppressing Output
 
 # COMMAND ----------
 
+# Runs the setup steps of a lesson concurrently where their dependencies allow,
+# e.g. the clones of producer, date_lookup and user_lookup are independent.
+# Stands in for sys.stdout while the setup steps run, collecting what each
+# thread prints into that thread's own buffer (if it has one).
+class ThreadBufferedOutput:
+    def __init__(self, stdout):
+        import threading
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        return (self.stdout if buffer is None else buffer).write(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+class SetupGraph:
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.steps = {}
+        self.timings = {}
+        
+    def step(self, name, function, depends_on=[]):
+        assert name not in self.steps, f"The setup step \"{name}\" is already defined"
+        self.steps[name] = (function, depends_on)
+        return self
+    
+    def run(self):
+        import io, sys, time
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        
+        for name, (function, depends_on) in self.steps.items():
+            for dependency in depends_on:
+                assert dependency in self.steps, f"The setup step \"{name}\" depends on the undefined step \"{dependency}\""
+        
+        start = time.time()
+        
+        # Each step's output is held back and printed in one piece once the step
+        # completes, so that steps running at the same time don't interleave.
+        output = ThreadBufferedOutput(sys.stdout)
+        
+        # A failure is handed back with the output, so that the failing step's prints are still shown
+        def run_step(name):
+            output.local.buffer = io.StringIO()
+            error = None
+            try:
+                step_start = time.time()
+                self.steps[name][0]()
+                self.timings[name] = (step_start-start, time.time()-step_start)
+            except Exception as e:
+                error = e
+            finally:
+                text, output.local.buffer = output.local.buffer.getvalue(), None
+            return text, error
+        
+        done, running = set(), {}
+        sys.stdout = output
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                while len(done) < len(self.steps):
+                    for name, (function, depends_on) in self.steps.items():
+                        if name not in done and name not in running.values() and all(d in done for d in depends_on):
+                            running[executor.submit(run_step, name)] = name
+                    
+                    assert running, f"The setup steps {sorted(set(self.steps)-done)} have circular dependencies"
+                    
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        name = running.pop(future)
+                        text, error = future.result()
+                        print(text, end="")
+                        if error is not None: raise error
+                        done.add(name)
+        finally:
+            sys.stdout = output.stdout
+        
+        self.print_timings(time.time()-start)
+        
+    def print_timings(self, total):
+        width = max(len(name) for name in self.timings)
+        print(f"\nSetup steps:")
+        for name, (offset, duration) in sorted(self.timings.items(), key=lambda item: item[1][0]):
+            print(f"  {name.ljust(width)}  started at {offset:6.1f} seconds, took {duration:6.1f} seconds")
+        serial = sum(duration for offset, duration in self.timings.values())
+        print(f"  Completed in {total:.1f} seconds ({serial:.1f} seconds if run serially)")
+        
+None # Suppressing Output
+
+# COMMAND ----------
+
+def code_fingerprint(function):
+    import hashlib, inspect
+    
+    module = function.__module__
+    seen, hashes = set(), []
+    
+    # Hash the bytecode and constants, not the source, as notebook cells have no stable file or line numbers
+    def hash_code(code):
+        parts = [code.co_code.hex(), repr(code.co_names)]
+        parts += [hash_code(c) if inspect.iscode(c) else repr(c) for c in code.co_consts]
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+    
+    def global_names(code):
+        return set(code.co_names).union(*[global_names(c) for c in code.co_consts if inspect.iscode(c)])
+    
+    # A stage also depends on the helpers it calls (e.g. parse_heart_rate or InsertOnlyUpsert),
+    # so the functions and classes of this notebook that it references are hashed with it, as
+    # are those referenced through a registry (e.g. silver_parsers) or a default argument, and
+    # the data it reads from globals (e.g. completed_workouts_query or topic_schemas).
+    # Library code (pyspark, builtins) comes with the runtime and is not walked.
+    def visit(value):
+        if isinstance(value, (str, bytes, int, float, bool, type(None))):
+            hashes.append(repr(value))
+            return
+        
+        if id(value) in seen: return
+        seen.add(id(value))
+        
+        if inspect.ismethod(value):
+            visit(value.__func__)
+            visit(type(value.__self__)) # Bound methods (e.g. DA.data_factory.load) also depend on the rest of their class
+        elif inspect.isfunction(value):
+            if value.__module__ != module: return
+            hashes.append(hash_code(value.__code__))
+            for name in sorted(global_names(value.__code__)):
+                if name in value.__globals__: visit(value.__globals__[name])
+            for default in value.__defaults__ or (): visit(default)
+        elif inspect.isclass(value):
+            for cls in value.__mro__:
+                if cls.__module__ != module: continue
+                for member in vars(cls).values(): visit(getattr(member, "__func__", member))
+        elif isinstance(value, dict):
+            # Values are walked rather than passed to repr(), which would render a function by its address
+            hashes.append(f"dict({len(value)})")
+            for key, item in value.items():
+                visit(key)
+                visit(item)
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            hashes.append(f"{type(value).__name__}({len(value)})")
+            for item in (sorted(value, key=repr) if isinstance(value, (set, frozenset)) else value): visit(item)
+        elif type(value).__module__ == module:
+            visit(type(value))
+    
+    visit(function)
+    return hashlib.sha256("|".join(hashes).encode()).hexdigest()
+
+# Snapshots the output of each pipeline stage of a lesson so that re-running the lesson can
+# restore the stage instead of recomputing it. A stage is keyed by the versions of the source
+# tables, its code, its arguments and the key of the stage before it. Table directories and
+# checkpoints are copied as-is so restored checkpoints still match the Delta table IDs.
+class StageCache:
+    def __init__(self, source_tables):
+        import hashlib
+        
+        self.cache_dir = f"{DA.working_dir_prefix}/_stage_cache/{DA.lesson}"
+        self.live = False
+        
+        versions = [f"{table}@{spark.sql(f'DESCRIBE HISTORY {table} LIMIT 1').first()['version']}" for table in source_tables]
+        self.fingerprint = hashlib.sha256("|".join(versions).encode()).hexdigest()
+        
+    def run(self, name, function, tables=[], paths=[], args=(), kwargs={}, inputs=[]):
+        import hashlib, time
+        
+        # Once a stage runs on top of existing outputs, nothing downstream can be trusted to the cache
+        if self.live or any(spark.catalog._jcatalog.tableExists(table) for table in tables):
+            self.live = True
+            return function(*args, **kwargs)
+        
+        key = "|".join([self.fingerprint, name, code_fingerprint(function), repr(args), repr(sorted(kwargs.items())), repr(inputs)])
+        self.fingerprint = hashlib.sha256(key.encode()).hexdigest()
+        snapshot_dir = f"{self.cache_dir}/{name}_{self.fingerprint[:16]}"
+        
+        outputs = [f"{DA.paths.user_db}/{table}" for table in tables] + paths
+        relative = lambda path: path[len(DA.paths.working_dir)+1:]
+        
+        if DA.paths.exists(f"{snapshot_dir}/_SUCCESS"):
+            start = int(time.time())
+            print(f"Restoring {name} from the stage cache", end="...")
+            for path in outputs:
+                if DA.paths.exists(f"{snapshot_dir}/{relative(path)}"):
+                    dbutils.fs.cp(f"{snapshot_dir}/{relative(path)}", path, True)
+            for table in tables:
+                spark.sql(f"CREATE TABLE IF NOT EXISTS {table} USING DELTA LOCATION '{DA.paths.user_db}/{table}'")
+            print(f"({int(time.time())-start} seconds)")
+        else:
+            function(*args, **kwargs)
+            for path in outputs:
+                if DA.paths.exists(path):
+                    dbutils.fs.cp(path, f"{snapshot_dir}/{relative(path)}", True)
+            dbutils.fs.put(f"{snapshot_dir}/_SUCCESS", self.fingerprint, True)
+
+def cached_stage(name, function, tables, checkpoints=[]):
+    def run_stage(*args, **kwargs):
+        if DA.stage_cache is None: return function(*args, **kwargs)
+        paths = [f"{DA.paths.checkpoints}/{checkpoint}" for checkpoint in checkpoints]
+        return DA.stage_cache.run(name, function, tables, paths, args, kwargs)
+    return run_stage
+
+None # Suppressing Output
+
+# COMMAND ----------
+
 def create_producer_table_source():
     import time
     
@@ -56,26 +262,182 @@ def create_date_lookup():
     
     total = spark.read.table("date_lookup").count()
     print(f"({int(time.time())-start} seconds / {total:,} records)")
+
+# Finds a pure expression that reproduces date_lookup's week_part so that bronze can derive it
+# without joining every record to the lookup. Each candidate week numbering is checked against
+# every date in the lookup; the best one is used if it is wrong for no more than max_exceptions
+# dates, which are then patched from a literal map. Otherwise the broadcast join is kept.
+# Dates outside the lookup's range get a null date and week_part, as they would from the join.
+def resolve_week_part(lookup_table="date_lookup", max_exceptions=32):
+    import time
+    from pyspark.sql import functions as F
+
+    start = int(time.time())
+    print(f"Resolving week_part against {lookup_table}", end="...")
+
+    weeks = {
+        "iso": ("year(date_add({d}, 3 - weekday({d})))", "weekofyear({d})"),
+        "iso_calendar_year": ("year({d})", "weekofyear({d})"),
+        "sunday": ("year({d})", "floor((dayofyear({d}) + dayofweek(trunc({d}, 'year')) - 2) / 7) + 1"),
+        "monday": ("year({d})", "floor((dayofyear({d}) + weekday(trunc({d}, 'year')) - 1) / 7) + 1"),
+        "day_of_year": ("year({d})", "floor((dayofyear({d}) - 1) / 7) + 1"),
+    }
+    candidates = {}
+    for name, (year, week) in weeks.items():
+        candidates[name] = "concat(" + year + ", '-', lpad(" + week + ", 2, '0'))"
+        candidates[f"{name}_unpadded"] = "concat(" + year + ", '-', " + week + ")"
+
+    lookup_df = spark.table(lookup_table).select("date", "week_part")
+    matches = lambda name: F.expr(candidates[name].format(d="date")).eqNullSafe(F.col("week_part"))
+    
+    mismatches = lookup_df.select(*[F.sum(F.when(matches(name), 0).otherwise(1)).alias(name) for name in candidates]).first().asDict()
+    best = min(candidates, key=lambda name: mismatches[name])
+
+    if mismatches[best] is None or mismatches[best] > max_exceptions:
+        print(f"({int(time.time())-start} seconds / no expression matches, using a broadcast join)")
+        return lambda df, timestamp_col="timestamp": df.join(F.broadcast(lookup_df), F.to_date((F.col(timestamp_col)/1000).cast("timestamp")) == F.col("date"), "left")
+    
+    exceptions = {row["date"]: row["week_part"] for row in lookup_df.filter(~matches(best)).collect()}
+    bounds = lookup_df.agg(F.min("date").alias("min"), F.max("date").alias("max")).first()
+    
+    def add_week_part(df, timestamp_col="timestamp"):
+        week_part = F.expr(candidates[best].format(d="date"))
+        if exceptions:
+            patches = F.create_map(*[F.lit(value) for pair in exceptions.items() for value in pair])
+            week_part = F.when(F.col("date").isin(list(exceptions)), patches[F.col("date")]).otherwise(week_part)
+        
+        covered = F.col("date").between(F.lit(bounds["min"]), F.lit(bounds["max"]))
+        
+        return (df.withColumn("date", F.to_date((F.col(timestamp_col)/1000).cast("timestamp")))
+                  .select(*df.columns, F.when(covered, F.col("date")).alias("date"), F.when(covered, week_part).alias("week_part")))
+    
+    print(f"({int(time.time())-start} seconds / \"{best}\" weeks with {len(exceptions):,} exceptions)")
+    return add_week_part
     
 None # Suppressing Output
 
 # COMMAND ----------
 
+# The formats the data factories can land files in, keyed by the name passed as
+# landing_format, along with the Spark format and write options for each.
+landing_formats = {
+    "json":      ("json",    {}),
+    "json.gz":   ("json",    {"compression": "gzip"}),
+    "json.zstd": ("json",    {"compression": "org.apache.hadoop.io.compress.ZStandardCodec"}),
+    "parquet":   ("parquet", {}),
+    "delta":     ("delta",   {}),
+}
+
+def write_landing(df, path, landing_format="json"):
+    assert landing_format in landing_formats, f"Unsupported landing format \"{landing_format}\", expected one of {list(landing_formats)}"
+    file_format, options = landing_formats[landing_format]
+    df.write.mode("append").format(file_format).options(**options).save(path)
+
+def read_landing_stream(path, schema, landing_format="json", **options):
+    # Auto Loader picks up compressed JSON and Parquet, Delta is streamed directly
+    file_format, _ = landing_formats[landing_format]
+    if file_format == "delta": 
+        return spark.readStream.format("delta").options(**options).load(path)
+    
+    # Auto Loader only honors its own prefixed rate limits
+    for key in ["maxFilesPerTrigger", "maxBytesPerTrigger"]:
+        if key in options: options[f"cloudFiles.{key}"] = options.pop(key)
+    
+    return (spark.readStream
+                 .format("cloudFiles")
+                 .schema(schema)
+                 .option("cloudFiles.format", file_format)
+                 .options(**options)
+                 .load(path))
+
+def landing_bytes(path):
+    try: files = dbutils.fs.ls(path)
+    except Exception: return 0
+    return sum(landing_bytes(f.path) if f.isDir() else f.size for f in files)
+
+None # Suppressing Output
+
+# COMMAND ----------
+
+def create_producer_daily_source():
+    import time
+    
+    ################################
+    # Staging the producer table by day
+    # Partitioning on the batch number lets every load prune down to its own
+    # days instead of scanning all of producer. The table lives in the source
+    # database so it is built once and then shared by every lesson.
+    start = int(time.time())
+    print(f"Staging to source database producer_daily", end="...")
+    spark.sql(f"""
+      CREATE TABLE IF NOT EXISTS {DA.source_db_name}.producer_daily
+      USING DELTA
+      PARTITIONED BY (day)
+      AS SELECT *, CASE WHEN date <= '2019-12-01' THEN 1 ELSE dayofmonth(date) END AS day
+      FROM {DA.source_db_name}.producer
+    """) # No location for source db
+    print(f"({int(time.time())-start} seconds)")
+
 class DailyDataFactory:
-    def __init__(self, target_dir, reset=True, starting_batch=1, max_batch=16):
+    def __init__(self, target_dir, reset=True, starting_batch=1, max_batch=16, landing_format="json"):
         from pyspark.sql import functions as F
         
-        self.rawDF = spark.table(f"{DA.source_db_name}.producer").withColumn("day", F.when(F.col("date") <= '2019-12-01', 1).otherwise(F.dayofmonth("date")))
+        create_producer_daily_source()
+        self.rawDF = spark.table(f"{DA.source_db_name}.producer_daily")
         self.target_dir = target_dir
+        self.landing_format = landing_format
+        self.cursor_path = f"{target_dir}.cursor"
         self.max_batch = max_batch
         
         if reset == True:
             self.batch = starting_batch
             dbutils.fs.rm(self.target_dir, True)
+            dbutils.fs.rm(self.cursor_path)
         else:
-            self.batch = spark.read.json(DA.paths.source_daily).select(F.max(F.when((F.col("timestamp")/1000).cast("timestamp").cast("date") <= '2019-12-01', 1).otherwise(F.dayofmonth((F.col("timestamp")/1000).cast("timestamp").cast("date"))))).collect()[0][0]
+            self.batch = self.read_cursor()
+            
+    def count_files(self):
+        try: return len([f for f in dbutils.fs.ls(self.target_dir) if f.name.startswith("part-")])
+        except Exception: return 0
+
+    def read_cursor(self):
+        import json
+        from pyspark.sql import functions as F
+        
+        # The cursor is trusted only while it agrees with the directory listing;
+        # otherwise fall back to scanning the emitted files and rewrite it.
+        try: 
+            cursor = json.loads(dbutils.fs.head(self.cursor_path))
+            if cursor["files"] == self.count_files(): return cursor["batch"]
+            print(f"The cursor at \"{self.cursor_path}\" is out of date, recovering from the emitted files")
+        except Exception: 
+            print(f"The cursor at \"{self.cursor_path}\" is missing, recovering from the emitted files")
+        
+        batch = spark.read.format(landing_formats[self.landing_format][0]).load(self.target_dir).select(F.max(F.when((F.col("timestamp")/1000).cast("timestamp").cast("date") <= '2019-12-01', 1).otherwise(F.dayofmonth((F.col("timestamp")/1000).cast("timestamp").cast("date"))))).collect()[0][0]
+        self.write_cursor(batch)
+        return batch
+    
+    def write_cursor(self, batch):
+        import json
+        
+        # Written to a temp file first so a reader never sees a partial cursor,
+        # a reader that finds no cursor at all simply takes the recovery path.
+        temp_path = f"{self.cursor_path}.tmp"
+        dbutils.fs.put(temp_path, json.dumps({"batch": batch, "files": self.count_files()}), True)
+        dbutils.fs.rm(self.cursor_path)
+        dbutils.fs.mv(temp_path, self.cursor_path)
             
     def load(self, continuous=False, silent=False):
+        if DA.stage_cache is None: return self.load_now(continuous, silent)
+        DA.stage_cache.run("load", self.load_now, paths=[self.target_dir, self.cursor_path], args=(continuous, silent), 
+                           inputs=self.cache_inputs())
+        self.batch = self.read_cursor()
+    
+    # Everything besides the code that decides what load() writes, keying its stage cache entry
+    def cache_inputs(self):
+        return [self.batch, self.max_batch, self.landing_format]
+    
+    def load_now(self, continuous=False, silent=False):
         import time
         start = int(time.time())
         
@@ -90,65 +452,797 @@ class DailyDataFactory:
             self.load_batch(self.batch, self.batch+1)
             self.batch += 1
             
+        self.write_cursor(self.batch)
         print(f"({int(time.time())-start} seconds)")
     
     def load_batch(self, min_batch, max_batch):
         from pyspark.sql import functions as F
-        (self.rawDF
-             .filter(F.col("day") >= min_batch)
-             .filter(F.col("day") <= max_batch)
-             .drop("date", "week_part", "day")
-             .write.mode("append").format("json").save(self.target_dir))
+        write_landing(self.rawDF
+                          .filter(F.col("day") >= min_batch)
+                          .filter(F.col("day") <= max_batch)
+                          .drop("date", "week_part", "day"), self.target_dir, self.landing_format)
+
+# Emits every record of producer `scale` times. Each replica offsets the device_id and
+# user_id in the payload by a multiple of id_stride so the silver dedup keys stay unique,
+# while the topic mix and per-device skew of the original stream are preserved.
+# Replica 0 is the original data, so only it matches the user_lookup table.
+class ScaledDailyDataFactory(DailyDataFactory):
+    def __init__(self, target_dir, scale=10, id_stride=1000000, **kwargs):
+        assert scale >= 1, f"The scale must be at least 1, found {scale}"
+        assert scale * id_stride < 2**31, f"A scale of {scale} with an id_stride of {id_stride:,} overflows the INT user_id"
+        
+        self.scale = scale
+        self.id_stride = id_stride
+        super().__init__(target_dir, **kwargs)
+        
+    def cache_inputs(self):
+        return super().cache_inputs() + [self.scale, self.id_stride]
+        
+    def perturb_id(self, field):
+        pattern = f"'\"{field}\": ?([0-9]+)'"
+        field_id = f"regexp_extract(value, {pattern}, 1)"
+        return f"""
+            CASE WHEN {field_id} = '' THEN value
+            ELSE regexp_replace(value, {pattern}, concat('"{field}":', CAST(CAST({field_id} AS LONG) + replica * {self.id_stride} AS STRING)))
+            END"""
+    
+    def load_batch(self, min_batch, max_batch):
+        from pyspark.sql import functions as F
+        write_landing(self.rawDF
+                          .filter(F.col("day") >= min_batch)
+                          .filter(F.col("day") <= max_batch)
+                          .drop("date", "week_part", "day")
+                          .withColumn("replica", F.explode(F.sequence(F.lit(0), F.lit(self.scale-1))))
+                          .withColumn("value", F.col("value").cast("string"))
+                          .withColumn("value", F.expr(self.perturb_id("device_id")))
+                          .withColumn("value", F.expr(self.perturb_id("user_id")))
+                          .withColumn("value", F.col("value").cast("binary"))
+                          .withColumn("offset", F.col("offset") * self.scale + F.col("replica"))
+                          .withColumn("timestamp", F.col("timestamp") + F.col("replica"))
+                          .drop("replica"), self.target_dir, self.landing_format)
 
 None # Suppressing Output
 
 # COMMAND ----------
 
-def init_source_daily():
+class ReplayDataFactory:
+    def __init__(self, source_table, target_dir, events_per_second=None, compression=None, landing_format="json"):
+        import threading
+        from pyspark.sql import functions as F
+        
+        assert (events_per_second is None) != (compression is None), "Specify exactly one of events_per_second or compression"
+        
+        self.sourceDF = spark.table(source_table)
+        self.target_dir = target_dir
+        self.landing_format = landing_format
+        self.events_per_second = events_per_second
+        self.compression = compression
+        
+        # One row per arrival with its size and the original (Kafka) time at which it landed
+        self.arrivals = (self.sourceDF
+                             .groupBy("arrival")
+                             .agg(F.count("*").alias("events"), F.min("timestamp").alias("timestamp"))
+                             .orderBy("arrival")
+                             .collect())
+        
+        self.stopping = threading.Event()
+        self.thread = None
+        self.batch = 0
+        self.events = 0
+        self.elapsed = 0
+        
+    def schedule(self):
+        # Seconds after the start of the replay at which each arrival is due
+        if self.compression:
+            first = self.arrivals[0]["timestamp"]
+            return [(row["timestamp"]-first)/1000/self.compression for row in self.arrivals]
+        else:
+            due, total = [], 0
+            for row in self.arrivals:
+                due.append(total/self.events_per_second)
+                total += row["events"]
+            return due
+        
+    def target_rate(self):
+        if self.events_per_second: return self.events_per_second
+        first, last = self.arrivals[0]["timestamp"], self.arrivals[-1]["timestamp"]
+        return sum(row["events"] for row in self.arrivals) / max((last-first)/1000/self.compression, 1)
+        
+    def run(self):
+        import time
+        from pyspark.sql import functions as F
+        
+        start = time.time()
+        for row, due in zip(self.arrivals, self.schedule()):
+            if self.stopping.wait(max(start + due - time.time(), 0)): break
+            
+            write_landing(self.sourceDF.filter(F.col("arrival") == row["arrival"]).drop("arrival"), self.target_dir, self.landing_format)
+            
+            self.batch += 1
+            self.events += row["events"]
+            self.elapsed = time.time() - start
+            
+    def start(self):
+        import threading
+        
+        assert self.thread is None, "The replay has already been started"
+        print(f"Replaying {len(self.arrivals):,} arrivals at a target of {self.target_rate():,.1f} events/sec")
+        
+        self.thread = threading.Thread(target=self.run, name="replay_data_factory", daemon=True)
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.stopping.set()
+        self.await_termination()
+        
+    def await_termination(self, timeout=None):
+        if self.thread: self.thread.join(timeout)
+        
+    def report(self):
+        target = self.target_rate()
+        achieved = self.events / self.elapsed if self.elapsed else 0
+        print(f"Arrivals replayed: {self.batch:,} of {len(self.arrivals):,}")
+        print(f"Events replayed:   {self.events:,}")
+        print(f"Elapsed:           {self.elapsed:,.1f} seconds")
+        print(f"Target rate:       {target:,.1f} events/sec")
+        print(f"Achieved rate:     {achieved:,.1f} events/sec ({achieved/target:.0%} of target)")
+        print(f"Bytes landed:      {landing_bytes(self.target_dir):,} ({self.landing_format})")
+
+None # Suppressing Output
+
+# COMMAND ----------
+
+# Resizes the rate limit of a stream between triggers from its own progress: it shrinks
+# maxFilesPerTrigger when a batch overruns the trigger interval and grows it while the
+# source reports a backlog and batches finish well within the interval. The stream is
+# restarted from its checkpoint, between triggers, whenever the limit changes.
+class AdmissionController:
+    def __init__(self, start_query, trigger_seconds, max_files=2, min_files=1, max_files_limit=1024, utilization=0.8):
+        import threading
+        from pyspark import InheritableThread
+        
+        self.start_query = start_query
+        self.trigger_seconds = trigger_seconds
+        self.max_files = max_files
+        self.min_files = min_files
+        self.max_files_limit = max_files_limit
+        self.utilization = utilization
+        self.history = []
+        
+        self.query = start_query(max_files)
+        self.stopping = threading.Event()
+        # Restarted queries must keep the caller's local properties, e.g. spark.scheduler.pool
+        self.thread = InheritableThread(target=self.run, name="admission_controller", daemon=True)
+        self.thread.start()
+        
+    def recommend(self, progress):
+        duration = progress["durationMs"].get("triggerExecution", 0) / 1000
+        budget = self.trigger_seconds * self.utilization
+        backlog = max([float((source.get("metrics") or {}).get("numFilesOutstanding", 0)) for source in progress["sources"]] + [0])
+        
+        if duration > budget:
+            max_files = int(self.max_files * budget / duration)
+        elif backlog > 0 and duration < budget / 2:
+            max_files = int(self.max_files * min(budget / max(duration, 0.1), 2))
+        else:
+            return self.max_files
+        
+        return min(max(max_files, self.min_files), self.max_files_limit)
+    
+    def run(self):
+        import time
+        
+        last_batch_id = None
+        while not self.stopping.wait(self.trigger_seconds):
+            progress = self.query.lastProgress
+            if not self.query.isActive:
+                if self.query.exception() is not None:
+                    print(f"The stream \"{self.query.name}\" failed and is no longer resized, see report(): {self.query.exception()}")
+                break
+            if not progress or progress["batchId"] == last_batch_id: continue
+            last_batch_id = progress["batchId"]
+            
+            max_files = self.recommend(progress)
+            self.history.append((progress["timestamp"], self.max_files, progress["durationMs"].get("triggerExecution", 0), progress["numInputRows"]))
+            
+            # Ignore small adjustments, each one costs a restart of the stream
+            if abs(max_files - self.max_files) >= max(1, self.max_files / 4):
+                while self.query.status["isTriggerActive"]: time.sleep(0.1)
+                self.query.stop()
+                print(f"Resizing maxFilesPerTrigger for \"{self.query.name}\" from {self.max_files} to {max_files}")
+                self.max_files = max_files
+                self.query = self.start_query(max_files)
+    
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.query.stop()
+        
+    # Raises the failure of the controlled stream, if any, after printing the adjustments made
+    def report(self):
+        print(f"{'Batch time':<28} {'maxFilesPerTrigger':>18} {'Duration (ms)':>14} {'Input rows':>12}")
+        for timestamp, max_files, duration, rows in self.history:
+            print(f"{timestamp:<28} {max_files:>18,} {duration:>14,} {rows:>12,}")
+        
+        if self.query.exception() is not None: raise self.query.exception()
+
+None # Suppressing Output
+
+# COMMAND ----------
+
+def init_source_daily(scale=1, landing_format="json"):
     DA.paths.source_daily = f"{DA.paths.working_dir}/streams/daily.json"
-    DA.data_factory = DailyDataFactory(DA.paths.source_daily, reset=True)
     
+    if scale == 1: DA.data_factory = DailyDataFactory(DA.paths.source_daily, reset=True, landing_format=landing_format)
+    else:          DA.data_factory = ScaledDailyDataFactory(DA.paths.source_daily, scale=scale, reset=True, landing_format=landing_format)
+    
+None # Suppressing Output
+
+# COMMAND ----------
+
+# The cluster caches the metadata of the tables a stream reads and writes, and once those
+# tables are rebuilt by a previous lesson that cache is stale and the stream fails to start.
+# Refreshing just those tables up front avoids the failure; should a stream still fail, it is
+# retried once and the retry and its cost are recorded in DA.stream_retries.
+def run_stream(name, execute_stream, tables=[]):
+    import time
+    from pyspark.sql.utils import AnalysisException
+    
+    for table in tables:
+        if spark.catalog._jcatalog.tableExists(table): 
+            spark.catalog.refreshTable(table)
+    
+    start = time.time()
+    try: 
+        execute_stream()
+    except AnalysisException as e:
+        failed = time.time() - start
+        for table in tables:
+            if spark.catalog._jcatalog.tableExists(table): 
+                spark.catalog.refreshTable(table)
+        execute_stream()
+        
+        retry = {"stream": name, "error": str(e).split("\n")[0], "failed_seconds": failed, "retry_seconds": time.time()-start-failed}
+        DA.stream_retries.append(retry)
+        print(f"retried after \"{retry['error']}\" ({int(failed)} seconds lost)", end="...")
+
+# Totals the state held by the stateful operators of a query as of its last progress
+def state_size(query):
+    operators = (query.lastProgress or {}).get("stateOperators", [])
+    return {"rows": sum(op["numRowsTotal"] for op in operators), 
+            "bytes": sum(op["memoryUsedBytes"] for op in operators)}
+
+# Appends the stateOperators metrics of every active query to a Delta table after each new batch.
+# Lateness is how far a batch's oldest event trails the newest event the query had seen before it,
+# from which analyze() suggests a watermark, alongside flagging state that only ever grows.
+class StateMonitor:
+    def __init__(self, table_name="state_metrics", interval=30, query_names=None):
+        import threading
+        
+        self.table_name = table_name
+        self.interval = interval
+        self.query_names = query_names
+        self.last_batch = {}
+        self.max_event_time = {}
+        
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="state_monitor", daemon=True)
+        self.thread.start()
+    
+    def collect(self):
+        from datetime import datetime
+        from pyspark.sql import functions as F
+        
+        parse = lambda value: datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+        rows = []
+        
+        for query in spark.streams.active:
+            if self.query_names is not None and query.name not in self.query_names: continue
+            progress = query.lastProgress
+            if not progress or not progress["stateOperators"] or self.last_batch.get(query.id) == progress["batchId"]: continue
+            self.last_batch[query.id] = progress["batchId"]
+            
+            event_time = progress.get("eventTime", {})
+            lateness = None
+            if "min" in event_time and query.id in self.max_event_time:
+                lateness = max(0.0, (self.max_event_time[query.id] - parse(event_time["min"])).total_seconds())
+            if "max" in event_time:
+                self.max_event_time[query.id] = max(self.max_event_time.get(query.id, parse(event_time["max"])), parse(event_time["max"]))
+            
+            for op in progress["stateOperators"]:
+                rows.append((query.name, query.id, progress["batchId"], progress["timestamp"], op.get("operatorName", "stateful"), 
+                             op["numRowsTotal"], op["numRowsUpdated"], op.get("numRowsDroppedByWatermark", 0), op["memoryUsedBytes"], 
+                             event_time.get("watermark"), lateness))
+        
+        if rows:
+            schema = "query STRING, id STRING, batch_id LONG, timestamp STRING, operator STRING, state_rows LONG, rows_updated LONG, rows_dropped_by_watermark LONG, memory_bytes LONG, watermark STRING, lateness_seconds DOUBLE"
+            (spark.createDataFrame(rows, schema)
+                  .withColumn("timestamp", F.to_timestamp("timestamp"))
+                  .withColumn("watermark", F.to_timestamp("watermark"))
+                  .write
+                  .format("delta")
+                  .mode("append")
+                  .option("path", f"{DA.paths.user_db}/{self.table_name}")
+                  .saveAsTable(self.table_name))
+    
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.collect()
+    
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.collect()
+    
+    def analyze(self, min_batches=5):
+        import math
+        from datetime import datetime
+        
+        # Stateless queries record nothing, in which case the table is never created
+        rows = spark.table(self.table_name).orderBy("batch_id").collect() if spark.catalog._jcatalog.tableExists(self.table_name) else []
+        if not rows:
+            print("No state metrics were recorded, none of the monitored queries holds any state")
+            return
+        
+        history = {}
+        for row in rows:
+            history.setdefault((row["query"], row["operator"]), []).append(row)
+        
+        for (query, operator), rows in history.items():
+            print(f"{query} / {operator}: {rows[-1]['state_rows']:,} rows / {rows[-1]['memory_bytes']:,} bytes of state after batch {rows[-1]['batch_id']:,}")
+            if len(rows) < min_batches: continue
+            
+            # State that never shrank and was never trimmed by a watermark is not being evicted
+            watermarked = any(row["watermark"] is not None and row["watermark"] > datetime(1970, 1, 2) for row in rows)
+            growing = all(b["state_rows"] >= a["state_rows"] for a, b in zip(rows, rows[1:])) and rows[-1]["state_rows"] > rows[0]["state_rows"]
+            if growing and not watermarked:
+                print(f"...WARNING: state grew from {rows[0]['state_rows']:,} to {rows[-1]['state_rows']:,} rows over {len(rows):,} batches with no watermark to evict it")
+            elif growing:
+                print(f"...WARNING: state grew in every one of the last {len(rows):,} batches despite the watermark")
+            
+            late = sorted(row["lateness_seconds"] for row in rows if row["lateness_seconds"] is not None)
+            if late:
+                p99 = late[min(len(late)-1, int(len(late) * 0.99))]
+                print(f"...observed lateness: p99 {p99:,.1f} / max {late[-1]:,.1f} seconds; suggested watermark: \"{max(1, math.ceil(p99 * 1.5)):,} seconds\"")
+
 None # Suppressing Output
 
 # COMMAND ----------
 
 # This is the solution from lesson 2.03 and is included
 # here to fast-forward the student to this stage
-def _process_bronze():
+# Schemas of the JSON payloads multiplexed in bronze, by topic
+topic_schemas = {
+    "bpm": "device_id LONG, time TIMESTAMP, heartrate DOUBLE",
+    "workout": "user_id INT, workout_id INT, timestamp FLOAT, action STRING, session_id INT",
+    "user_info": """
+        user_id LONG, 
+        update_type STRING, 
+        timestamp FLOAT, 
+        dob STRING, 
+        sex STRING, 
+        gender STRING, 
+        first_name STRING, 
+        last_name STRING, 
+        address STRUCT<
+            street_address: STRING, 
+            city: STRING, 
+            state: STRING, 
+            zip: INT
+    >""",
+}
+
+# With typed=True, the payload of each topic is parsed once at ingest into a struct column
+# named after the topic, so the silver streams no longer each re-parse the raw JSON
+def _process_bronze(typed=False):
     import time
     from pyspark.sql import functions as F
-    from pyspark.sql.utils import AnalysisException
 
     start = int(time.time())
-    print(f"Processing the bronze table from the daily stream", end="...")
+    print(f"Processing the {'typed ' if typed else ''}bronze table from the daily stream", end="...")
         
     schema = "key BINARY, value BINARY, topic STRING, partition LONG, offset LONG, timestamp LONG"
-    date_lookup_df = spark.table("date_lookup").select("date", "week_part")
+    add_week_part = resolve_week_part()
 
     def execute_stream():
-        (spark.readStream
-              .format("cloudFiles")
-              .schema(schema)
-              .option("cloudFiles.format", "json")
-              .load(DA.paths.source_daily)
-              .join(F.broadcast(date_lookup_df), F.to_date((F.col("timestamp")/1000).cast("timestamp")) == F.col("date"), "left")
-              .writeStream
+        bronze_df = add_week_part(read_landing_stream(DA.paths.source_daily, schema, DA.data_factory.landing_format))
+        
+        if typed:
+            bronze_df = bronze_df.select("*", *[F.when(F.col("topic") == topic, F.from_json(F.col("value").cast("string"), topic_schema)).alias(topic) 
+                                                for topic, topic_schema in topic_schemas.items()])
+        
+        (bronze_df.writeStream
               .option("checkpointLocation", f"{DA.paths.checkpoints}/bronze.chk")
+              .option("mergeSchema", typed)
               .partitionBy("topic", "week_part")
               .option("path", f"{DA.paths.user_db}/bronze")
               .trigger(once=True)
               .table("bronze")
               .awaitTermination())
     
-    # The cluster is going to cache the state of the stream and it will be wrong.
-    # But it will also invalidate that cache allowing us to try again.
-    try: execute_stream()
-    except AnalysisException: execute_stream()
+    run_stream("bronze", execute_stream, ["bronze", "date_lookup"])
     
     total = spark.read.table("bronze").count()
-    print(f"({int(time.time())-start} seconds / {total:,} records)")
+    landed = landing_bytes(DA.paths.source_daily)
+    print(f"({int(time.time())-start} seconds / {total:,} records / {landed:,} bytes of {DA.data_factory.landing_format})")
+    
+DA.process_bronze = cached_stage("bronze", _process_bronze, ["bronze"], ["bronze.chk"])
+
+None # Suppressing Output
+
+# COMMAND ----------
+
+# Compacts the small files left in bronze by frequent triggers. File counts and sizes per partition
+# come from replaying the Delta log's add and remove actions rather than from scanning the table,
+# and only closed weeks (every week_part but the one holding the newest date, going by the files'
+# statistics) are compacted, so the OPTIMIZE never rewrites the partitions the stream is still
+# appending to. A conflicting commit is skipped until the next round.
+class CompactionScheduler:
+    def __init__(self, table_name="bronze", min_files=8, small_file_bytes=32*1024*1024, interval=None):
+        import threading
+        
+        self.table_name = table_name
+        self.min_files = min_files
+        self.small_file_bytes = small_file_bytes
+        self.interval = interval
+        self.history = []
+        self.errors = []
+        
+        self.stopping = threading.Event()
+        self.thread = None
+        if interval is not None:
+            self.thread = threading.Thread(target=self.run, name="compaction_scheduler", daemon=True)
+            self.thread.start()
+    
+    def log_actions(self):
+        import json, re
+        from pyspark.sql import functions as F
+        
+        log_dir = spark.sql(f"DESCRIBE DETAIL {self.table_name}").first()["location"] + "/_delta_log"
+        schema = "add STRUCT<path: STRING, size: LONG, partitionValues: MAP<STRING, STRING>, stats: STRING>, remove STRUCT<path: STRING>"
+        
+        # Commits after the last checkpoint are replayed on top of it
+        checkpoint = -1
+        if DA.paths.exists(f"{log_dir}/_last_checkpoint"):
+            checkpoint = json.loads(dbutils.fs.head(f"{log_dir}/_last_checkpoint"))["version"]
+        commits = [f.path for f in dbutils.fs.ls(log_dir) if re.fullmatch(r"\d{20}\.json", f.name) and int(f.name[:20]) > checkpoint]
+        
+        actions = []
+        if checkpoint >= 0:
+            actions.append(spark.read.schema(schema).parquet(f"{log_dir}/{checkpoint:020d}.checkpoint*.parquet")
+                                .withColumn("version", F.lit(checkpoint).cast("long")))
+        if commits:
+            actions.append(spark.read.schema(schema).json(commits)
+                                .withColumn("version", F.regexp_extract(F.input_file_name(), r"(\d{20})\.json", 1).cast("long")))
+        
+        if not actions: return None
+        df = actions[0]
+        for other in actions[1:]: df = df.unionByName(other)
+        return df
+    
+    def partition_stats(self):
+        from pyspark.sql import functions as F
+        
+        actions = self.log_actions()
+        if actions is None: return []
+        
+        # The last action on each path decides whether the file is still part of the table
+        files = latest_per_key(actions.select(F.coalesce("add.path", "remove.path").alias("path"), "version",
+                                              F.col("add.path").isNotNull().alias("added"),
+                                              F.col("add.size").alias("size"),
+                                              F.col("add.partitionValues").getItem("topic").alias("topic"),
+                                              F.col("add.partitionValues").getItem("week_part").alias("week_part"),
+                                              F.get_json_object("add.stats", "$.maxValues.date").cast("date").alias("max_date"))
+                                      .filter(F.col("path").isNotNull()), ["path"], "version")
+        
+        return (files.filter("added")
+                     .groupBy("topic", "week_part")
+                     .agg(F.count("*").alias("files"), F.sum("size").alias("bytes"), F.max("max_date").alias("max_date"))
+                     .collect())
     
-DA.process_bronze = _process_bronze
+    def candidates(self):
+        stats = [row for row in self.partition_stats() if row["week_part"] is not None]
+        dated = [row for row in stats if row["max_date"] is not None]
+        if not dated: return []
+        
+        # The open week holds the newest date; week_part labels don't necessarily sort by date
+        open_week = max(dated, key=lambda row: row["max_date"])["week_part"]
+        
+        return [row for row in dated 
+                if row["week_part"] != open_week 
+                and row["files"] >= self.min_files and row["bytes"] / row["files"] < self.small_file_bytes]
+    
+    def compact(self):
+        import time
+        
+        for row in self.candidates():
+            start = time.time()
+            try:
+                spark.sql(f"OPTIMIZE {self.table_name} WHERE topic = '{row['topic']}' AND week_part = '{row['week_part']}'")
+            except Exception as e:
+                if "Concurrent" not in str(e): raise
+                continue
+            self.history.append((row["topic"], row["week_part"], row["files"], row["bytes"], time.time() - start))
+    
+    def run(self):
+        from datetime import datetime
+        
+        # A failed round is recorded and retried at the next interval rather than ending the thread
+        while not self.stopping.wait(self.interval):
+            try:
+                self.compact()
+            except Exception as e:
+                self.errors.append((datetime.now(), e))
+                print(f"Compaction of {self.table_name} failed, retrying in {self.interval} seconds: {e}")
+    
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None: self.thread.join()
+    
+    def report(self):
+        print(f"{'Topic':<12} {'Week':<10} {'Files':>8} {'Bytes':>14} {'Seconds':>8}")
+        for topic, week_part, files, size, seconds in self.history:
+            print(f"{topic:<12} {week_part:<10} {files:>8,} {size:>14,} {seconds:>8.1f}")
+        for failed_at, error in self.errors:
+            print(f"...failed at {failed_at:%H:%M:%S}: {error}")
+
+None # Suppressing Output
+
+# COMMAND ----------
+
+# Keeps the latest row of each key without the shuffle-and-sort of a rank() window: each row is
+# carried through a max() aggregation as a struct led by the ordering column, so the greatest
+# struct is the latest row. The remaining columns break ties, so exactly one row per key is kept.
+def latest_per_key(df, keys, order_col):
+    from pyspark.sql import functions as F
+    
+    others = [col for col in df.columns if col not in keys and col != order_col]
+    
+    return (df.groupBy(*keys)
+              .agg(F.max(F.struct(order_col, *others)).alias("latest"))
+              .select(*keys, "latest.*")
+              .select(*df.columns))
+
+# A foreachBatch function that hands each micro-batch to several consumers. With more than one
+# consumer, the micro-batch is persisted and materialized once so that every consumer reads it
+# from the cache instead of recomputing the source, then unpersisted once all of them are done.
+class ForeachBatch:
+    def __init__(self, *consumers):
+        self.consumers = list(consumers)
+        self.batches = []
+
+    def __call__(self, microBatchDF, batchId):
+        if len(self.consumers) < 2:
+            for consumer in self.consumers: consumer(microBatchDF, batchId)
+            return
+        
+        context = spark.sparkContext
+        persisted = set(context._jsc.getPersistentRDDs().keySet())
+        
+        microBatchDF.persist()
+        try:
+            rows = microBatchDF.count()
+            for consumer in self.consumers: consumer(microBatchDF, batchId)
+            
+            # What the block manager still holds of the batch once every consumer has read it;
+            # partitions evicted along the way were recomputed by the consumers that needed them
+            infos = [info for info in context._jsc.sc().getRDDStorageInfo() if info.id() not in persisted]
+            cached = (sum(info.numCachedPartitions() for info in infos), sum(info.numPartitions() for info in infos),
+                      sum(info.memSize() for info in infos), sum(info.diskSize() for info in infos))
+            self.batches.append((batchId, rows, len(self.consumers), *cached))
+        finally:
+            microBatchDF.unpersist()
+
+    def report(self):
+        print(f"{'Batch':>8} {'Rows':>12} {'Consumers':>10} {'Partitions cached':>18} {'Memory (MB)':>12} {'Disk (MB)':>10}")
+        for batchId, rows, consumers, cached, partitions, memory, disk in self.batches:
+            print(f"{batchId:>8,} {rows:>12,} {consumers:>10,} {f'{cached:,} / {partitions:,}':>18} {memory/1024**2:>12,.1f} {disk/1024**2:>10,.1f}")
+
+# Given a time_col, the ON clause of the MERGE is narrowed to the micro-batch's range of that
+# column, and to its values of the target's partition columns, so that Delta can skip the
+# files of the target that cannot match. Only columns the ON clause equates with the same
+# column of the source are bounded, any other match could lie outside the batch's values.
+# The files scanned vs. skipped are kept per batch.
+class Upsert:
+    def __init__(self, query, update_temp="stream_updates", time_col=None):
+        import re
+        
+        self.query = query
+        self.update_temp = update_temp 
+        self.time_col = time_col
+        self.partition_cols = None
+        self.file_skipping = []
+        
+        target = re.search(r"MERGE\s+INTO\s+(\S+)", query, re.IGNORECASE)
+        self.target = target.group(1) if target else None
+        
+        # The bounds are written against the target's alias, e.g. "MERGE INTO heart_rate_silver a"
+        if time_col is not None:
+            alias = re.search(r"MERGE\s+INTO\s+\S+\s+(?:AS\s+)?(?!USING\b)(\w+)", query, re.IGNORECASE)
+            assert alias, f"Bounding the MERGE by \"{time_col}\" requires an alias for its target, e.g. \"MERGE INTO {self.target} t\""
+            self.alias = alias.group(1)
+            
+            # Columns of the form "alias.col = source.col" (in either order)
+            on = re.search(r"\bON\b(.*?)(?=\bWHEN\b)", query, re.IGNORECASE | re.DOTALL)
+            pairs = re.findall(r"(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)", on.group(1) if on else "")
+            self.equated = {c1.lower() for a1, c1, a2, c2 in pairs + [(a2, c2, a1, c1) for a1, c1, a2, c2 in pairs]
+                            if a1.lower() == self.alias.lower() and a2.lower() != self.alias.lower() and c1.lower() == c2.lower()}
+            assert time_col.lower() in self.equated, f"Bounding the MERGE by \"{time_col}\" requires its ON clause to equate it, e.g. \"{self.alias}.{time_col} = s.{time_col}\""
+
+    def bounds(self, microBatchDF):
+        from pyspark.sql import functions as F
+        
+        if self.partition_cols is None:
+            self.partition_cols = spark.sql(f"DESCRIBE DETAIL {self.target}").first()["partitionColumns"]
+        
+        # Literals are rendered by Spark and cast back to the column type so they survive the round trip
+        types = {field.name: field.dataType.simpleString() for field in microBatchDF.schema.fields}
+        literal = lambda col, value: f"CAST('{value}' AS {types[col]})"
+        
+        row = microBatchDF.agg(F.min(self.time_col).cast("string").alias("min"), F.max(self.time_col).cast("string").alias("max")).first()
+        if row["min"] is None: return []
+        predicates = [f"{self.alias}.{self.time_col} BETWEEN {literal(self.time_col, row['min'])} AND {literal(self.time_col, row['max'])}"]
+        
+        for col in [col for col in self.partition_cols if col in types and col.lower() in self.equated]:
+            values = [r[0] for r in microBatchDF.select(F.col(col).cast("string")).distinct().limit(33).collect()]
+            if len(values) <= 32 and None not in values:
+                predicates.append(f"{self.alias}.{col} IN ({', '.join(literal(col, value) for value in values)})")
+        
+        return predicates
+
+    def upsertToDelta(self, microBatchDF, batch):
+        import re
+        
+        query = self.query
+        if self.time_col is None:
+            microBatchDF.createOrReplaceTempView(self.update_temp)
+            microBatchDF._jdf.sparkSession().sql(query)
+        else:
+            # The bounds and the MERGE both read the micro-batch, which is computed only once
+            microBatchDF.persist()
+            try:
+                predicates = self.bounds(microBatchDF)
+                if predicates:
+                    query = re.sub(r"\bON\b(.*?)(?=\bWHEN\b)", lambda m: f"ON {' AND '.join(predicates)} AND ({m.group(1).strip()}) ", query, count=1, flags=re.IGNORECASE | re.DOTALL)
+                
+                microBatchDF.createOrReplaceTempView(self.update_temp)
+                microBatchDF._jdf.sparkSession().sql(query)
+            finally:
+                microBatchDF.unpersist()
+        
+        if self.target is None: return
+        metrics = spark.sql(f"DESCRIBE HISTORY {self.target} LIMIT 1").first()["operationMetrics"]
+        if "numTargetFilesBeforeSkipping" in metrics:
+            self.file_skipping.append((batch, int(metrics["numTargetFilesBeforeSkipping"]), int(metrics["numTargetFilesAfterSkipping"])))
+
+    def report(self):
+        print(f"{'Batch':>8} {'Files in target':>16} {'Files scanned':>14} {'Files skipped':>14}")
+        for batch, before, after in self.file_skipping:
+            print(f"{batch:>8,} {before:>16,} {after:>14,} {before-after:>14,}")
+
+# Identifies the writes of one stream to one table for txnAppId. The stream id is read from the
+# checkpoint, so resetting the checkpoint also resets the transaction versions.
+def checkpoint_app_id(checkpoint, table_name):
+    import json
+    
+    stream_id = json.loads(dbutils.fs.head(f"{checkpoint}/metadata"))["id"]
+    return f"{table_name}-{stream_id}"
+
+# Drop-in replacement for an Upsert whose MERGE only has a WHEN NOT MATCHED THEN INSERT * clause.
+# Rather than joining the micro-batch against the whole table, only the target rows within the
+# batch's time range are read to anti-join against, and the rest is appended. The append is
+# made idempotent with txnAppId/txnVersion, keyed by the stream's checkpoint_app_id.
+class InsertOnlyUpsert:
+    def __init__(self, table_name, keys, checkpoint, time_col="time"):
+        self.table_name = table_name
+        self.keys = keys
+        self.checkpoint = checkpoint
+        self.time_col = time_col
+        self.app_id = None
+
+    def upsertToDelta(self, microBatchDF, batch):
+        from pyspark.sql import functions as F
+
+        if self.app_id is None:
+            self.app_id = checkpoint_app_id(self.checkpoint, self.table_name)
+
+        microBatchDF.persist()
+        try:
+            bounds = microBatchDF.agg(F.count("*").alias("rows"), F.min(self.time_col).alias("min"), F.max(self.time_col).alias("max")).first()
+            if bounds["rows"] == 0: return
+
+            # Rows with a null time can't match any existing key, so they are all appended
+            newDF = microBatchDF
+            if bounds["min"] is not None:
+                existingDF = (spark.table(self.table_name)
+                                   .filter(F.col(self.time_col).between(bounds["min"], bounds["max"]))
+                                   .select(*self.keys))
+                newDF = microBatchDF.join(existingDF, self.keys, "left_anti")
+
+            (newDF.write
+                  .format("delta")
+                  .mode("append")
+                  .option("txnAppId", self.app_id)
+                  .option("txnVersion", batch)
+                  .saveAsTable(self.table_name))
+        finally:
+            microBatchDF.unpersist()
+
+# Returns the payload of a topic as the struct column "v". Typed bronze tables already carry it
+# parsed, and the JSON is only parsed for rows landed before the typed columns were added.
+def parse_value(bronzeDF, topic):
+    from pyspark.sql import functions as F
+    
+    parsed = F.from_json(F.col("value").cast("string"), topic_schemas[topic])
+    if topic in bronzeDF.columns: parsed = F.coalesce(F.col(topic), parsed)
+    return parsed.alias("v")
+
+# Each parser turns the raw bronze rows of one topic into the shape of its silver table.
+# They work on both streaming and static DataFrames so the same logic can back a
+# dedicated stream per topic or a single demultiplexing stream over bronze.
+def parse_heart_rate(bronzeDF):
+    from pyspark.sql import functions as F
+
+    return (bronzeDF
+        .select(parse_value(bronzeDF, "bpm"))
+        .select("v.*", F.when(F.col("v.heartrate") <= 0, "Negative BPM").otherwise("OK").alias("bpm_check"))
+        .withWatermark("time", "30 seconds")
+        .dropDuplicates(["device_id", "time"]))
+
+def parse_workouts(bronzeDF):
+    from pyspark.sql import functions as F
+
+    return (bronzeDF
+        .select(parse_value(bronzeDF, "workout"))
+        .select("v.*")
+        .select("user_id", "workout_id", F.col("timestamp").cast("timestamp").alias("time"), "action", "session_id")
+        .withWatermark("time", "30 seconds")
+        .dropDuplicates(["user_id", "time"]))
+
+# Deduplicates bronze records on a 64 or 128-bit hash of the landed columns instead of on the whole
+# row, so the dedup state holds a couple of longs per record rather than the key and value
+# binaries. A watermark on the record's own timestamp lets that state be evicted.
+def dedup_by_hash(bronzeDF, watermark="30 seconds", bits=64):
+    from pyspark.sql import functions as F
+    
+    assert bits in [64, 128], f"Unsupported hash size: {bits}"
+    
+    cols = [F.col(col) for col in ["key", "value", "topic", "partition", "offset", "timestamp"] if col in bronzeDF.columns]
+    hashes = [F.xxhash64(*cols).alias("record_hash")]
+    if bits == 128: hashes.append(F.xxhash64(F.lit("record_hash_hi"), *cols).alias("record_hash_hi"))
+    hash_names = ["record_hash", "record_hash_hi"][:len(hashes)]
+    
+    return (bronzeDF
+        .select("*", *hashes, (F.col("timestamp")/1000).cast("timestamp").alias("record_time"))
+        .withWatermark("record_time", watermark)
+        .dropDuplicates([*hash_names, "record_time"])
+        .drop(*hash_names, "record_time"))
+
+# dedup is either "row" (every column), "hash" (64-bit) or "hash128"; changing it on an
+# existing checkpoint changes the shape of the dedup state, so use a new checkpoint
+def parse_users(bronzeDF, dedup="row", watermark="30 seconds"):
+    from pyspark.sql import functions as F
+
+    if dedup == "row":
+        dedupedDF = bronzeDF.dropDuplicates()
+    else:
+        dedupedDF = dedup_by_hash(bronzeDF, watermark, 128 if dedup == "hash128" else 64)
+
+    return (dedupedDF
+        .select(parse_value(dedupedDF, "user_info")).select("v.*")
+        .select(F.sha2(F.concat(F.col("user_id"), F.lit("BEANS")), 256).alias("alt_id"),
+            F.col('timestamp').cast("timestamp").alias("updated"),
+            F.to_date('dob','MM/dd/yyyy').alias('dob'),
+            'sex', 'gender','first_name','last_name',
+            'address.*', "update_type"))
+
+# Registry of the topics multiplexed in bronze and the parser for each
+silver_parsers = {
+    "bpm": parse_heart_rate,
+    "workout": parse_workouts,
+    "user_info": parse_users,
+}
 
 None # Suppressing Output
 
@@ -157,19 +1251,9 @@ None # Suppressing Output
 def _process_heart_rate_silver_v0():
     import time
     from pyspark.sql import functions as F
-    from pyspark.sql.utils import AnalysisException
 
     start = int(time.time())
     print("Processing the heart_rate_silver table", end="...")
-
-    class Upsert:
-        def __init__(self, sql_query, update_temp="stream_updates"):
-            self.sql_query = sql_query
-            self.update_temp = update_temp 
-
-        def upsertToDelta(self, microBatchDF, batch):
-            microBatchDF.createOrReplaceTempView(self.update_temp)
-            microBatchDF._jdf.sparkSession().sql(self.sql_query)
     
     spark.sql("CREATE TABLE IF NOT EXISTS heart_rate_silver (device_id LONG, time TIMESTAMP, heartrate DOUBLE) USING DELTA")
     
@@ -178,7 +1262,7 @@ def _process_heart_rate_silver_v0():
       USING stream_updates b
       ON a.device_id=b.device_id AND a.time=b.time
       WHEN NOT MATCHED THEN INSERT *
-    """)
+    """, time_col="time")
 
     def execute_stream():
         (spark.readStream
@@ -196,15 +1280,12 @@ def _process_heart_rate_silver_v0():
               .start()
               .awaitTermination())
     
-    # The cluster is going to cache the state of the stream and it will be wrong.
-    # But it will also invalidate that cache allowing us to try again.
-    try: execute_stream()
-    except AnalysisException: execute_stream()
+    run_stream("heart_rate_silver", execute_stream, ["bronze", "heart_rate_silver"])
     
     total = spark.read.table("heart_rate_silver").count() 
     print(f"({int(time.time())-start} seconds / {total:,} records)")
 
-DA.process_heart_rate_silver_v0 = _process_heart_rate_silver_v0
+DA.process_heart_rate_silver_v0 = cached_stage("heart_rate_silver_v0", _process_heart_rate_silver_v0, ["heart_rate_silver"], ["heart_rate.chk"])
 
 None # Suppressing Output
 
@@ -213,37 +1294,18 @@ None # Suppressing Output
 def _process_heart_rate_silver():
     import time
     from pyspark.sql import functions as F
-    from pyspark.sql.utils import AnalysisException
 
     start = int(time.time())
     print("Processing the heart_rate_silver table", end="...")
 
-    class Upsert:
-        def __init__(self, sql_query, update_temp="stream_updates"):
-            self.sql_query = sql_query
-            self.update_temp = update_temp 
-
-        def upsertToDelta(self, microBatchDF, batch):
-            microBatchDF.createOrReplaceTempView(self.update_temp)
-            microBatchDF._jdf.sparkSession().sql(self.sql_query)
-    
     spark.sql("CREATE TABLE IF NOT EXISTS heart_rate_silver (device_id LONG, time TIMESTAMP, heartrate DOUBLE, bpm_check STRING) USING DELTA")
     
-    streamingMerge=Upsert("""
-      MERGE INTO heart_rate_silver a
-      USING stream_updates b
-      ON a.device_id=b.device_id AND a.time=b.time
-      WHEN NOT MATCHED THEN INSERT *
-    """)
+    streamingMerge=InsertOnlyUpsert("heart_rate_silver", ["device_id", "time"], f"{DA.paths.checkpoints}/heart_rate.chk")
 
     def execute_stream():
-        (spark.readStream
-              .table("bronze")
-              .filter("topic = 'bpm'")
-              .select(F.from_json(F.col("value").cast("string"), "device_id LONG, time TIMESTAMP, heartrate DOUBLE").alias("v"))
-              .select("v.*", F.when(F.col("v.heartrate") <= 0, "Negative BPM").otherwise("OK").alias("bpm_check"))
-              .withWatermark("time", "30 seconds")
-              .dropDuplicates(["device_id", "time"])
+        (parse_heart_rate(spark.readStream
+                               .table("bronze")
+                               .filter("topic = 'bpm'"))
               .writeStream
               .foreachBatch(streamingMerge.upsertToDelta)
               .outputMode("update")
@@ -252,15 +1314,12 @@ def _process_heart_rate_silver():
               .start()
               .awaitTermination())    
     
-    # The cluster is going to cache the state of the stream and it will be wrong.
-    # But it will also invalidate that cache allowing us to try again.
-    try: execute_stream()
-    except AnalysisException: execute_stream()
+    run_stream("heart_rate_silver", execute_stream, ["bronze", "heart_rate_silver"])
         
     total = spark.read.table("heart_rate_silver").count() 
     print(f"({int(time.time())-start} seconds / {total:,} records)")
 
-DA.process_heart_rate_silver = _process_heart_rate_silver
+DA.process_heart_rate_silver = cached_stage("heart_rate_silver", _process_heart_rate_silver, ["heart_rate_silver"], ["heart_rate.chk"])
 
 None # Suppressing Output
 
@@ -269,41 +1328,19 @@ None # Suppressing Output
 def _process_workouts_silver(once=False, processing_time="15 seconds"):
     import time
     from pyspark.sql import functions as F
-    from pyspark.sql.utils import AnalysisException
 
     start = int(time.time())
     print("Processing the workouts_silver table", end="...")
     
-    spark.sql(f"CREATE TABLE IF NOT EXISTS workouts_silver (user_id INT, workout_id INT, time TIMESTAMP, action STRING, session_id INT) USING DELTA")
+    spark.sql(f"CREATE TABLE IF NOT EXISTS workouts_silver (user_id INT, workout_id INT, time TIMESTAMP, action STRING, session_id INT) USING DELTA TBLPROPERTIES (delta.enableChangeDataFeed = true)")
     
-    class Upsert:
-        def __init__(self, query, update_temp="stream_updates"):
-            self.query = query
-            self.update_temp = update_temp 
-
-        def upsertToDelta(self, microBatchDF, batch):
-            microBatchDF.createOrReplaceTempView(self.update_temp)
-            microBatchDF._jdf.sparkSession().sql(self.query)
-    
-    sql_query = """
-        MERGE INTO workouts_silver a
-        USING workout_updates b
-        ON a.user_id=b.user_id AND a.time=b.time
-        WHEN NOT MATCHED THEN INSERT *
-        """
-
-    streamingMerge=Upsert(sql_query, "workout_updates")
+    streamingMerge=InsertOnlyUpsert("workouts_silver", ["user_id", "time"], f"{DA.paths.checkpoints}/workouts.chk")
     
     def execute_stream():
-        (spark.readStream
-              .option("ignoreDeletes", True)
-              .table("bronze")
-              .filter("topic = 'workout'")
-              .select(F.from_json(F.col("value").cast("string"), "user_id INT, workout_id INT, timestamp FLOAT, action STRING, session_id INT").alias("v"))
-              .select("v.*")
-              .select("user_id", "workout_id", F.col("timestamp").cast("timestamp").alias("time"), "action", "session_id")
-              .withWatermark("time", "30 seconds")
-              .dropDuplicates(["user_id", "time"])
+        (parse_workouts(spark.readStream
+                             .option("ignoreDeletes", True)
+                             .table("bronze")
+                             .filter("topic = 'workout'"))
               .writeStream
               .foreachBatch(streamingMerge.upsertToDelta)
               .outputMode("update")
@@ -313,93 +1350,305 @@ def _process_workouts_silver(once=False, processing_time="15 seconds"):
               .start()
               .awaitTermination())
         
-    # The cluster is going to cache the state of the stream and it will be wrong.
-    # But it will also invalidate that cache allowing us to try again.
-    try: execute_stream()
-    except AnalysisException: execute_stream()
+    run_stream("workouts_silver", execute_stream, ["bronze", "workouts_silver"])
     
     total = spark.read.table("workouts_silver").count() 
     print(f"({int(time.time())-start} seconds / {total:,} records)")
     
-DA.process_workouts_silver = _process_workouts_silver
+DA.process_workouts_silver = cached_stage("workouts_silver", _process_workouts_silver, ["workouts_silver"], ["workouts.chk"])
 
 None # Suppressing Output
 
 # COMMAND ----------
 
-def _process_completed_workouts():
+completed_workouts_query = """
+    SELECT a.user_id, a.workout_id, a.session_id, a.start_time start_time, b.end_time end_time, a.in_progress AND (b.in_progress IS NULL) in_progress
+    FROM (
+      SELECT user_id, workout_id, session_id, time start_time, null end_time, true in_progress
+      FROM {source}
+      WHERE action = "start") a
+    LEFT JOIN (
+      SELECT user_id, workout_id, session_id, null start_time, time end_time, false in_progress
+      FROM {source}
+      WHERE action = "stop") b
+    ON a.user_id = b.user_id AND a.session_id = b.session_id
+"""
+
+# Keeps completed_workouts up to date from the change data feed of workouts_silver. Only the sessions
+# touched since the source version last processed (kept in the target's table properties) are
+# recomputed, and their old rows are swapped for the new ones in a single MERGE. Recomputing a
+# session is idempotent, so a failure before the version is recorded only repeats the work.
+# Without a recorded version, or when the change feed does not cover it, the table is rebuilt.
+def merge_completed_workouts(source="workouts_silver", target="completed_workouts"):
+    from pyspark.sql.utils import AnalysisException
+
+    if spark.sql(f"SHOW TBLPROPERTIES {source}").filter("key = 'delta.enableChangeDataFeed' AND value = 'true'").count() == 0:
+        spark.sql(f"ALTER TABLE {source} SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
+
+    latest = spark.sql(f"DESCRIBE HISTORY {source} LIMIT 1").first()["version"]
+    spark.sql(f"SELECT * FROM {source} VERSION AS OF {latest}").createOrReplaceTempView("TEMP_workouts_snapshot")
+
+    last = None
+    if spark.catalog._jcatalog.tableExists(target):
+        last = {row["key"]: row["value"] for row in spark.sql(f"SHOW TBLPROPERTIES {target}").collect()}.get("completed_workouts.source_version")
+    if last is not None and int(last) == latest: return 0
+
+    touched = None
+    if last is not None:
+        try:
+            touched = (spark.read
+                            .option("readChangeFeed", True)
+                            .option("startingVersion", int(last) + 1)
+                            .option("endingVersion", latest)
+                            .table(source)
+                            .select("user_id", "session_id")
+                            .distinct())
+            touched.createOrReplaceTempView("TEMP_touched_sessions")
+            sessions = touched.count()
+        except AnalysisException:
+            touched = None
+
+    if touched is None:
+        spark.sql(completed_workouts_query.format(source="TEMP_workouts_snapshot")).write.mode("overwrite").saveAsTable(target)
+        sessions = spark.table(target).count()
+    else:
+        spark.sql(f"""
+            CREATE OR REPLACE TEMP VIEW TEMP_touched_workouts AS
+            SELECT w.* FROM TEMP_workouts_snapshot w LEFT SEMI JOIN TEMP_touched_sessions t 
+            ON w.user_id <=> t.user_id AND w.session_id <=> t.session_id
+        """)
+        spark.sql(f"""
+            MERGE INTO {target} t
+            USING (
+              SELECT user_id, CAST(NULL AS INT) workout_id, session_id, CAST(NULL AS TIMESTAMP) start_time, CAST(NULL AS TIMESTAMP) end_time, CAST(NULL AS BOOLEAN) in_progress, 'delete' change
+              FROM TEMP_touched_sessions
+              UNION ALL
+              SELECT *, 'insert' change
+              FROM ({completed_workouts_query.format(source="TEMP_touched_workouts")})
+            ) s
+            ON t.user_id <=> s.user_id AND t.session_id <=> s.session_id AND s.change = 'delete'
+            WHEN MATCHED THEN DELETE
+            WHEN NOT MATCHED AND s.change = 'insert'
+              THEN INSERT (user_id, workout_id, session_id, start_time, end_time, in_progress) 
+              VALUES (s.user_id, s.workout_id, s.session_id, s.start_time, s.end_time, s.in_progress)
+        """)
+
+    spark.sql(f"ALTER TABLE {target} SET TBLPROPERTIES ('completed_workouts.source_version' = '{latest}')")
+    return sessions
+
+def _process_completed_workouts(incremental=True):
     import time
     from pyspark.sql import functions as F
 
     start = int(time.time())
     print("Processing the completed_workouts table", end="...")
 
-    spark.sql("""
-        CREATE OR REPLACE TEMP VIEW TEMP_completed_workouts AS (
-          SELECT a.user_id, a.workout_id, a.session_id, a.start_time start_time, b.end_time end_time, a.in_progress AND (b.in_progress IS NULL) in_progress
-          FROM (
-            SELECT user_id, workout_id, session_id, time start_time, null end_time, true in_progress
-            FROM workouts_silver
-            WHERE action = "start") a
-          LEFT JOIN (
-            SELECT user_id, workout_id, session_id, null start_time, time end_time, false in_progress
-            FROM workouts_silver
-            WHERE action = "stop") b
-          ON a.user_id = b.user_id AND a.session_id = b.session_id
-        )
-    """)
-    
-    (spark.table("TEMP_completed_workouts").write.mode("overwrite").saveAsTable("completed_workouts"))
+    if incremental:
+        sessions = merge_completed_workouts()
+        print(f"{sessions:,} sessions recomputed", end="...")
+    else:
+        spark.sql(f"CREATE OR REPLACE TEMP VIEW TEMP_completed_workouts AS ({completed_workouts_query.format(source='workouts_silver')})")
+        (spark.table("TEMP_completed_workouts").write.mode("overwrite").saveAsTable("completed_workouts"))
     
     total = spark.read.table("completed_workouts").count() 
     print(f"({int(time.time())-start} seconds / {total:,} records)")
     
-DA.process_completed_workouts = _process_completed_workouts
+DA.process_completed_workouts = cached_stage("completed_workouts", _process_completed_workouts, ["completed_workouts"])
 
 None # Suppressing Output
 
 # COMMAND ----------
 
+# Holds the static side of a stream-static join as a cached DataFrame, hinted for broadcast, so that
+# micro-batches join to it rather than recomputing it. It is rebuilt only when the Delta version of
+# one of the tables it is built from has moved on since it was cached.
+class StaticSide:
+    def __init__(self, build, tables):
+        self.build = build
+        self.tables = tables
+        self.versions = None
+        self.df = None
+        self.refreshes = 0
+        self.size_in_bytes = 0
+        
+    def current_versions(self):
+        return {table: spark.sql(f"DESCRIBE HISTORY {table} LIMIT 1").first()["version"] for table in self.tables}
+    
+    def get(self):
+        from pyspark.sql import functions as F
+        
+        versions = self.current_versions()
+        if versions != self.versions:
+            if self.df is not None: self.df.unpersist()
+            self.df = self.build().cache()
+            self.df.count()
+            self.size_in_bytes = int(self.df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes().toString())
+            self.versions = versions
+            self.refreshes += 1
+        
+        return F.broadcast(self.df)
+    
+    def report(self):
+        versions = ", ".join(f"{table}@{version}" for table, version in (self.versions or {}).items())
+        print(f"...static side: {self.refreshes:,} refreshes / {self.size_in_bytes:,} bytes broadcast ({versions})")
+
+# Sizes the time buckets of the binned range join from the 90th percentile of session lengths,
+# so that most sessions fall into no more than two buckets. The floor keeps an empty table, or
+# one of zero-length sessions, from exploding each session into a bucket per second.
+def session_bucket_seconds(sessions="completed_workouts", percentile=0.9, min_seconds=3600):
+    row = spark.sql(f"""
+        SELECT percentile_approx(CAST(end_time AS LONG) - CAST(start_time AS LONG), {percentile}) seconds
+        FROM {sessions}
+        WHERE end_time >= start_time""").first()
+    return max(min_seconds, row["seconds"] or 0)
+
+# Joins heart rate recordings to the workout sessions of their device. Given bucket_seconds, both
+# sides are binned into fixed time buckets, each session exploded into every bucket it overlaps,
+# so the join becomes an equi-join on (device_id, bucket) with the exact BETWEEN applied after.
+# A recording only has one bucket, so it still matches each of its sessions only once.
+def workout_sessions_query(bucket_seconds):
+    return f"""
+        SELECT a.user_id, b.device_id, workout_id, session_id, start_time, end_time, 
+               explode(sequence(floor(CAST(start_time AS LONG) / {bucket_seconds}), floor(CAST(end_time AS LONG) / {bucket_seconds}))) bucket
+        FROM completed_workouts a
+        INNER JOIN user_lookup b
+        ON a.user_id = b.user_id
+        WHERE end_time >= start_time"""
+
+def workout_bpm_query(heart_rate="TEMP_heart_rate_silver", bucket_seconds=None):
+    if bucket_seconds is None:
+        return f"""
+            SELECT d.user_id, d.workout_id, d.session_id, time, heartrate
+            FROM {heart_rate} c
+            INNER JOIN (
+              SELECT a.user_id, b.device_id, workout_id, session_id, start_time, end_time
+              FROM completed_workouts a
+              INNER JOIN user_lookup b
+              ON a.user_id = b.user_id) d
+            ON c.device_id = d.device_id AND time BETWEEN start_time AND end_time
+            WHERE c.bpm_check = 'OK'"""
+    
+    return f"""
+        SELECT d.user_id, d.workout_id, d.session_id, time, heartrate
+        FROM (
+          SELECT *, floor(CAST(time AS LONG) / {bucket_seconds}) bucket
+          FROM {heart_rate}) c
+        INNER JOIN ({workout_sessions_query(bucket_seconds)}) d
+        ON c.device_id = d.device_id AND c.bucket = d.bucket AND time BETWEEN start_time AND end_time
+        WHERE c.bpm_check = 'OK'"""
+
+# Runs both forms of the workout_bpm join as a batch over heart_rate_silver, comparing the
+# join operators planned, the rows produced and the best time out of several runs
+def benchmark_workout_bpm(runs=3, bucket_seconds=None):
+    import re, time
+    
+    bucket_seconds = bucket_seconds or session_bucket_seconds()
+    plans = {"BETWEEN join": workout_bpm_query("heart_rate_silver"), 
+             f"binned join ({bucket_seconds:,}s buckets)": workout_bpm_query("heart_rate_silver", bucket_seconds)}
+    
+    print(f"{'Plan':<32} {'Join operators':<48} {'Rows':>12} {'Best (s)':>9}")
+    for name, query in plans.items():
+        df = spark.sql(query)
+        plan = df._jdf.queryExecution().executedPlan().toString()
+        joins = ", ".join(sorted(set(re.findall(r"\w*(?:Join|NestedLoop)\w*", plan))))
+        rows = df.count()
+        
+        timings = []
+        for run in range(runs):
+            start = time.time()
+            df.write.format("noop").mode("overwrite").save()
+            timings.append(time.time() - start)
+        
+        print(f"{name:<32} {joins:<48} {rows:>12,} {min(timings):>9.2f}")
+
+# foreachBatch writers for the two stream-static joins of the gold tables. Each keeps its static
+# side in a StaticSide: the binned sessions joined to user_lookup for workout_bpm, and user_bins
+# for workout_bpm_summary. Writes are made idempotent with the stream's checkpoint_app_id.
+# Unless bucket_seconds is given, the buckets are re-sized whenever the sessions are rebuilt.
+class WorkoutBpmWriter:
+    def __init__(self, checkpoint, table_name="workout_bpm", path=None, bucket_seconds=None):
+        self.checkpoint = checkpoint
+        self.table_name = table_name
+        self.path = path
+        self.fixed_bucket_seconds = bucket_seconds
+        self.bucket_seconds = None
+        self.sessions = StaticSide(self.build_sessions, ["completed_workouts", "user_lookup"])
+    
+    def build_sessions(self):
+        self.bucket_seconds = self.fixed_bucket_seconds or session_bucket_seconds()
+        return spark.sql(workout_sessions_query(self.bucket_seconds))
+    
+    def __call__(self, microBatchDF, batchId):
+        from pyspark.sql import functions as F
+        
+        # Both sides must be binned with the same bucket size, so the sessions are fetched first
+        d = self.sessions.get()
+        c = microBatchDF.filter("bpm_check = 'OK'").withColumn("bucket", F.floor(F.col("time").cast("long") / self.bucket_seconds))
+        
+        writer = (c.join(d, (c["device_id"] == d["device_id"]) & (c["bucket"] == d["bucket"]) & c["time"].between(d["start_time"], d["end_time"]))
+                   .select(d["user_id"], d["workout_id"], d["session_id"], c["time"], c["heartrate"])
+                   .write
+                   .format("delta")
+                   .mode("append")
+                   .option("txnAppId", checkpoint_app_id(self.checkpoint, self.table_name))
+                   .option("txnVersion", batchId))
+        if self.path is not None: writer = writer.option("path", self.path)
+        writer.saveAsTable(self.table_name)
+    
+    def report(self):
+        self.sessions.report()
+        print(f"...bucket size: {self.bucket_seconds or 0:,} seconds")
+
+class WorkoutBpmSummaryWriter:
+    def __init__(self, checkpoint, table_name="workout_bpm_summary", path=None):
+        self.checkpoint = checkpoint
+        self.table_name = table_name
+        self.path = path
+        self.user_bins = StaticSide(lambda: spark.table("user_bins"), ["user_bins"])
+    
+    # Called with the complete aggregation of workout_bpm, which replaces the table each batch
+    def __call__(self, microBatchDF, batchId):
+        writer = (self.user_bins.get()
+                      .join(microBatchDF, "user_id")
+                      .select("workout_id", "session_id", "user_id", "age", "gender", "city", "state", "min_bpm", "avg_bpm", "max_bpm", "num_recordings")
+                      .write
+                      .format("delta")
+                      .mode("overwrite")
+                      .option("txnAppId", checkpoint_app_id(self.checkpoint, self.table_name))
+                      .option("txnVersion", batchId))
+        if self.path is not None: writer = writer.option("path", self.path)
+        writer.saveAsTable(self.table_name)
+    
+    def report(self):
+        self.user_bins.report()
+
 def _process_workout_bpm():
     import time
-    from pyspark.sql.utils import AnalysisException
     
     start = int(time.time())
     print("Processing the workout_bpm table", end="...")
 
-    spark.readStream.table("heart_rate_silver").createOrReplaceTempView("TEMP_heart_rate_silver")
-    
-    spark.sql("""
-        SELECT d.user_id, d.workout_id, d.session_id, time, heartrate
-        FROM TEMP_heart_rate_silver c
-        INNER JOIN (
-          SELECT a.user_id, b.device_id, workout_id, session_id, start_time, end_time
-          FROM completed_workouts a
-          INNER JOIN user_lookup b
-          ON a.user_id = b.user_id) d
-        ON c.device_id = d.device_id AND time BETWEEN start_time AND end_time
-        WHERE c.bpm_check = 'OK'""").createOrReplaceTempView("TEMP_workout_bpm")
+    checkpoint = f"{DA.paths.checkpoints}/workout_bpm.chk"
+    workout_bpm_writer = WorkoutBpmWriter(checkpoint, path=f"{DA.paths.user_db}/workout_bpm")
     
     def execute_stream():
-        (spark.table("TEMP_workout_bpm")
+        (spark.readStream
+            .table("heart_rate_silver")
             .writeStream
-            .format("delta")
+            .foreachBatch(workout_bpm_writer)
             .outputMode("append")
-            .option("checkpointLocation", f"{DA.paths.checkpoints}/workout_bpm.chk")
-            .option("path", f"{DA.paths.user_db}/workout_bpm")
+            .option("checkpointLocation", checkpoint)
             .trigger(once=True)
-            .table("workout_bpm")
+            .start()
             .awaitTermination())
     
-    # The cluster is going to cache the state of the stream and it will be wrong.
-    # But it will also invalidate that cache allowing us to try again.
-    try: execute_stream()
-    except AnalysisException: execute_stream()
+    run_stream("workout_bpm", execute_stream, ["heart_rate_silver", "completed_workouts", "user_lookup", "workout_bpm"])
 
     total = spark.read.table("workout_bpm").count() 
     print(f"({int(time.time())-start} seconds / {total:,} records)")
+    workout_bpm_writer.report()
     
-DA.process_workout_bpm = _process_workout_bpm
+DA.process_workout_bpm = cached_stage("workout_bpm", _process_workout_bpm, ["workout_bpm"], ["workout_bpm.chk"])
 
 None # Suppressing Output    
 
@@ -446,18 +1695,10 @@ None # Suppressing Output
 
 # COMMAND ----------
 
-def batch_rank_upsert(microBatchDF, batchId):
-    from pyspark.sql.window import Window
+def rank_upsert_users(microBatchDF, batchId):
     from pyspark.sql import functions as F
 
-    window = Window.partitionBy("alt_id").orderBy(F.col("updated").desc())
-    
-    (microBatchDF
-        .filter(F.col("update_type").isin(["new", "update"]))
-        .withColumn("rank", F.rank().over(window))
-        .filter("rank == 1")
-        .drop("rank")
-        .createOrReplaceTempView("ranked_updates"))
+    latest_per_key(microBatchDF.filter(F.col("update_type").isin(["new", "update"])), ["alt_id"], "updated").createOrReplaceTempView("ranked_updates")
     
     microBatchDF._jdf.sparkSession().sql("""
         MERGE INTO users u
@@ -469,69 +1710,65 @@ def batch_rank_upsert(microBatchDF, batchId):
           THEN INSERT *
     """)
 
-    (microBatchDF
+def append_delete_requests(microBatchDF, batchId, app_id="batch_rank_upsert"):
+    from pyspark.sql import functions as F
+
+    requestsDF = (microBatchDF
         .filter("update_type = 'delete'")
         .select("alt_id", 
                 F.col("updated").alias("requested"), 
                 F.date_add("updated", 30).alias("deadline"), 
                 F.lit("requested").alias("status"))
+        .dropDuplicates(["alt_id", "requested"]))
+
+    # A replayed day carries the same requests again; only append the new ones
+    if spark.catalog._jcatalog.tableExists("delete_requests"):
+        requestsDF = requestsDF.join(spark.table("delete_requests").select("alt_id", "requested"), ["alt_id", "requested"], "left_anti")
+
+    (requestsDF
         .write
         .format("delta")
         .mode("append")
         .option("txnVersion", batchId)
-        .option("txnAppId", "batch_rank_upsert")
+        .option("txnAppId", app_id)
         .option("path", f"{DA.paths.user_db}/delete_requests")
         .saveAsTable("delete_requests"))
+
+# Both consumers read the same micro-batch, which is computed only once. The
+# delete_requests append is keyed by the stream writing it, so the users and
+# silver streams don't skip each other's batches.
+def users_upsert(checkpoint):
+    def append(microBatchDF, batchId):
+        append_delete_requests(microBatchDF, batchId, checkpoint_app_id(checkpoint, "delete_requests"))
+
+    return ForeachBatch(rank_upsert_users, append)
     
-def _process_users():
+def _process_users(dedup="row"):
     import time
     from pyspark.sql import functions as F
-    from pyspark.sql.utils import AnalysisException
     
     start = int(time.time())
     print(f"Processing the users table", end="...")
+    queries = []
 
     spark.sql(f"CREATE TABLE IF NOT EXISTS users (alt_id STRING, dob DATE, sex STRING, gender STRING, first_name STRING, last_name STRING, street_address STRING, city STRING, state STRING, zip INT, updated TIMESTAMP) USING DELTA")
     
-    schema = """
-        user_id LONG, 
-        update_type STRING, 
-        timestamp FLOAT, 
-        dob STRING, 
-        sex STRING, 
-        gender STRING, 
-        first_name STRING, 
-        last_name STRING, 
-        address STRUCT<
-            street_address: STRING, 
-            city: STRING, 
-            state: STRING, 
-            zip: INT
-    >"""
-    
+    checkpoint = f"{DA.paths.checkpoints}/users.chk"
+
     def execute_stream():
-        (spark.readStream
-            .table("bronze")
-            .filter("topic = 'user_info'")
-            .dropDuplicates()
-            .select(F.from_json(F.col("value").cast("string"), schema).alias("v")).select("v.*")
-            .select(F.sha2(F.concat(F.col("user_id"), F.lit("BEANS")), 256).alias("alt_id"),
-                F.col('timestamp').cast("timestamp").alias("updated"),
-                F.to_date('dob','MM/dd/yyyy').alias('dob'),
-                'sex', 'gender','first_name','last_name',
-                'address.*', "update_type")
+        query = (parse_users(spark.readStream
+                                  .table("bronze")
+                                  .filter("topic = 'user_info'"), dedup)
             .writeStream
-            .foreachBatch(batch_rank_upsert)
+            .foreachBatch(users_upsert(checkpoint))
             .outputMode("update")
-            .option("checkpointLocation", f"{DA.paths.checkpoints}/users.chk")
+            .option("checkpointLocation", checkpoint)
             .trigger(once=True)
-            .start()
-            .awaitTermination())    
+            .start())
+        queries.append(query)
+        query.awaitTermination()
 
-    # The cluster is going to cache the state of the stream and it will be wrong.
-    # But it will also invalidate that cache allowing us to try again.
-    try: execute_stream()
-    except AnalysisException: execute_stream()
+    run_stream("users", execute_stream, ["bronze", "users", "delete_requests"])
         
     print(f"({int(time.time())-start} seconds)")
 
@@ -543,13 +1780,94 @@ def _process_users():
 
     total = spark.read.table("users").count()
     print(f"...users: {total} records)")
+
+    state = state_size(queries[-1])
+    print(f"...dedup state ({dedup}): {state['rows']:,} rows / {state['bytes']:,} bytes")
     
-DA.process_users = _process_users
+DA.process_users = cached_stage("users", _process_users, ["users", "delete_requests"], ["users.chk"])
     
 None # Suppressing Output
 
 # COMMAND ----------
 
+class SilverDemux:
+    def __init__(self, parsers=silver_parsers):
+        self.parsers = parsers
+        self.writers = {}
+        self.fan_out = ForeachBatch()
+
+    def route(self, topic, writer):
+        assert topic in self.parsers, f"No parser is registered for the topic \"{topic}\""
+        if topic not in self.writers: self.fan_out.consumers.append(self.consumer(topic))
+        self.writers[topic] = writer
+        return self
+
+    def consumer(self, topic):
+        from pyspark.sql import functions as F
+        
+        return lambda microBatchDF, batchId: self.writers[topic](self.parsers[topic](microBatchDF.filter(F.col("topic") == topic)), batchId)
+
+    def process_batch(self, microBatchDF, batchId):
+        # Every topic is served from the one scan of bronze, which ForeachBatch
+        # holds in memory instead of re-reading its files per writer.
+        self.fan_out(microBatchDF, batchId)
+
+    # The parsers only see static micro-batches, so their dropDuplicates is per batch. Records
+    # repeated across batches (DailyDataFactory reloads the previous day on every call) are left
+    # to the writers, which must be idempotent: InsertOnlyUpsert and append_delete_requests
+    # anti-join against their targets and the users MERGE only applies newer updates.
+    def stream_writer(self, source_table="bronze"):
+        from pyspark.sql import functions as F
+
+        return (spark.readStream
+                     .option("ignoreDeletes", True)
+                     .table(source_table)
+                     .filter(F.col("topic").isin(list(self.writers)))
+                     .writeStream
+                     .foreachBatch(self.process_batch)
+                     .outputMode("update"))
+
+# Processes heart_rate_silver, workouts_silver and users from a single
+# read of the multiplex bronze table instead of one stream per topic.
+def _process_silver():
+    import time
+
+    start = int(time.time())
+    print("Processing the silver tables from the bronze table", end="...")
+
+    spark.sql("CREATE TABLE IF NOT EXISTS heart_rate_silver (device_id LONG, time TIMESTAMP, heartrate DOUBLE, bpm_check STRING) USING DELTA")
+    spark.sql("CREATE TABLE IF NOT EXISTS workouts_silver (user_id INT, workout_id INT, time TIMESTAMP, action STRING, session_id INT) USING DELTA TBLPROPERTIES (delta.enableChangeDataFeed = true)")
+    spark.sql("CREATE TABLE IF NOT EXISTS users (alt_id STRING, dob DATE, sex STRING, gender STRING, first_name STRING, last_name STRING, street_address STRING, city STRING, state STRING, zip INT, updated TIMESTAMP) USING DELTA")
+
+    checkpoint = f"{DA.paths.checkpoints}/silver.chk"
+
+    demux = (SilverDemux()
+        .route("bpm", InsertOnlyUpsert("heart_rate_silver", ["device_id", "time"], checkpoint).upsertToDelta)
+        .route("workout", InsertOnlyUpsert("workouts_silver", ["user_id", "time"], checkpoint).upsertToDelta)
+        .route("user_info", users_upsert(checkpoint)))
+
+    def execute_stream():
+        (demux.stream_writer("bronze")
+              .option("checkpointLocation", checkpoint)
+              .queryName("silver")
+              .trigger(once=True)
+              .start()
+              .awaitTermination())
+
+    run_stream("silver", execute_stream, ["bronze", "heart_rate_silver", "workouts_silver", "users", "delete_requests"])
+
+    print(f"({int(time.time())-start} seconds)")
+
+    for table_name in ["heart_rate_silver", "workouts_silver", "users", "delete_requests"]:
+        total = spark.read.table(table_name).count()
+        print(f"...{table_name}: {total:,} records")
+
+DA.process_silver = cached_stage("silver", _process_silver, ["heart_rate_silver", "workouts_silver", "users", "delete_requests"], ["silver.chk"])
+
+None # Suppressing Output
+
+# COMMAND ----------
+
 def age_bins(dob_col):
     from pyspark.sql import functions as F
 
@@ -594,7 +1912,7 @@ def _process_user_bins():
     print(f"({int(time.time())-start} seconds / {total:,} records)")
     
 
-DA.process_user_bins = _process_user_bins    
+DA.process_user_bins = cached_stage("user_bins", _process_user_bins, ["user_bins"])    
 
 None # Suppressing Output
 
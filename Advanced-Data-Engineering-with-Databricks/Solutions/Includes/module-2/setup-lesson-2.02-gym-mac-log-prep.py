@@ -10,50 +10,81 @@
 gym_mac_logs_source = f"{DA.data_source_uri}/gym-logs"
 DA.paths.gym_mac_logs_json = f"{DA.paths.working_dir}/gym_mac_logs.json"
 
-def install_gym_logs():
+def list_files_by_day(source):
+    # A single listing of the source, indexed by the yyyymmdd prefix of each file name
+    files_by_day = {}
+    for file in dbutils.fs.ls(source):
+        files_by_day.setdefault(file.name[:8], []).append(file)
+    return files_by_day
+
+def copy_files(files, target_dir, max_workers=8, max_attempts=3):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    
+    def copy_file(file):
+        for attempt in range(1, max_attempts+1):
+            try:
+                dbutils.fs.cp(file.path, f"{target_dir}/{file.name}")
+                return file.size
+            except Exception as e:
+                if attempt == max_attempts: raise
+                print(f"...retrying {file.name} after attempt #{attempt} failed: {e}")
+                time.sleep(2**attempt)
+    
+    # Copies are bound by round trips to the object store, not by bandwidth, so run them concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return sum(executor.map(copy_file, files))
+
+def install_gym_logs(files_by_day):
+    import time
+    
     # Remove existing files
     # dbutils.fs.rm(DA.paths.gym_mac_logs_json, True)
 
     # Copies files to demo directory
-    files = dbutils.fs.ls(gym_mac_logs_source)
-    for curr_file in [file.name for file in files if file.name.startswith(f"2019120")]:
-        dbutils.fs.cp(f"{gym_mac_logs_source}/{curr_file}", f"{DA.paths.gym_mac_logs_json}/{curr_file}")
+    start = int(time.time())
+    print(f"Installing gym logs", end="...")
+    files = [file for day in range(1, 10) for file in files_by_day.get(f"2019120{day}", [])]
+    total = copy_files(files, DA.paths.gym_mac_logs_json)
+    print(f"({int(time.time())-start} seconds / {len(files)} files / {total:,} bytes)")
 
 
 # COMMAND ----------
 
 class DataFactory:
-    def __init__(self, source, userdir):
+    def __init__(self, source, userdir, files_by_day=None):
         self.source = source
         self.userdir = userdir
+        self.files_by_day = files_by_day or list_files_by_day(source)
         self.curr_day = 10
     
+    def load_day(self):
+        files = self.files_by_day.get(f"201912{self.curr_day}", [])
+        print(f"Loading day #{self.curr_day}")
+        for curr_file in [file.name for file in files]:
+            print(f"...{curr_file}")
+        total = copy_files(files, self.userdir)
+        print(f"...{total:,} bytes")
+        self.curr_day += 1
+    
     def load(self, continuous=False):
-        files = dbutils.fs.ls(self.source)
         if self.curr_day > 16:
             print("Data source exhausted\n")
         elif continuous == True:
             while self.curr_day <= 16:
-                print(f"Loading day #{self.curr_day}")
-                for curr_file in [file.name for file in files if file.name.startswith(f"201912{self.curr_day}")]:
-                    print(f"...{curr_file}")
-                    dbutils.fs.cp(f"{self.source}/{curr_file}", f"{self.userdir}/{curr_file}")
-                self.curr_day += 1
+                self.load_day()
             print("Data source exhausted")
         else:
-            print(f"Loading day #{self.curr_day}")
-            for curr_file in [file.name for file in files if file.name.startswith(f"201912{self.curr_day}")]:
-                print(f"...{curr_file}")
-                dbutils.fs.cp(f"{self.source}/{curr_file}", f"{self.userdir}/{curr_file}")
-            self.curr_day += 1
+            self.load_day()
 
 # COMMAND ----------
 
 DA.cleanup()
 DA.init()
 
-install_gym_logs()
-DA.data_factory = DataFactory(gym_mac_logs_source, DA.paths.gym_mac_logs_json)
+gym_mac_logs_by_day = list_files_by_day(gym_mac_logs_source)
+install_gym_logs(gym_mac_logs_by_day)
+DA.data_factory = DataFactory(gym_mac_logs_source, DA.paths.gym_mac_logs_json, gym_mac_logs_by_day)
 
 DA.conclude_setup()
 
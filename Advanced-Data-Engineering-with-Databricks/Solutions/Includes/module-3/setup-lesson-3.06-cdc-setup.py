@@ -24,9 +24,10 @@ def create_cdc_raw():
 # COMMAND ----------
 
 class CdcDataFactory:
-    def __init__(self, demohome, reset=True, max_batch=3):
+    def __init__(self, demohome, reset=True, max_batch=3, landing_format="json"):
         self.rawDF = spark.read.format("delta").load(filepath)
         self.userdir = demohome
+        self.landing_format = landing_format
         self.batch = 1
         self.max_batch = max_batch
         if reset == True:
@@ -37,20 +38,14 @@ class CdcDataFactory:
             print("Data source exhausted\n")
         elif continuous == True:
             while self.batch <= max_batch:
-                (self.rawDF.filter(F.col("batch") == self.batch)
-                    .select('mrn','dob','sex','gender','first_name','last_name','street_address','zip','city','state','updated')
-                    .write
-                    .mode("append")
-                    .format("json")
-                    .save(self.userdir))
+                write_landing(self.rawDF.filter(F.col("batch") == self.batch)
+                    .select('mrn','dob','sex','gender','first_name','last_name','street_address','zip','city','state','updated'), 
+                    self.userdir, self.landing_format)
                 self.batch += 1
         else:
-            (self.rawDF.filter(F.col("batch") == self.batch)
-                .select('mrn','dob','sex','gender','first_name','last_name','street_address','zip','city','state','updated')
-                .write
-                .mode("append")
-                .format("json")
-                .save(self.userdir))
+            write_landing(self.rawDF.filter(F.col("batch") == self.batch)
+                .select('mrn','dob','sex','gender','first_name','last_name','street_address','zip','city','state','updated'), 
+                self.userdir, self.landing_format)
             self.batch += 1
 
 